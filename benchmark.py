@@ -0,0 +1,231 @@
+#
+# Micro-benchmarks for sendmessage.py
+# Usage:
+#   python3 benchmark.py [name]
+#   name is one of the benchmarks below, all of them are run if omitted
+#
+
+import contextlib
+import io
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from urllib import parse
+
+import sendmessage
+
+def legacyTailoring(tailoring,title):
+    # how Bark.push matched the tailoring rules before TailoringIndex
+    for t in tailoring:
+        t_title = t.get('title')
+        matchtitle = False
+        if isinstance(t_title, str):
+            if title == t_title:
+                matchtitle = True
+        if isinstance(t_title, list):
+            for e in t_title:
+                if isinstance(e, str):
+                    if title == e:
+                        matchtitle = True
+                if isinstance(e, list):
+                    for r in e:
+                        ptn = re.compile(r)
+                        matchtitle = bool(ptn.search(title))
+                        if matchtitle:
+                            break
+        if matchtitle:
+            return(t)
+    return(None)
+
+def benchTailoring():
+    # per message cost of finding the tailoring rule, the title matches no rule which is the worst case
+    print('tailoring rules    legacy (us/msg)    index (us/msg)')
+    for count in (10, 100, 1000, 5000):
+        tailoring = []
+        for i in range(count):
+            tailoring.append({'title': ['title ' + str(i), ['^host' + str(i) + ' .* down$']], 'group': 'g' + str(i)})
+        title = 'host-unknown is down'
+        index = sendmessage.TailoringIndex(tailoring)
+        number = max(1, 20000 // count)
+        legacy = min(timeit.repeat(lambda: legacyTailoring(tailoring, title), number=number, repeat=3)) / number
+        indexed = min(timeit.repeat(lambda: index.match(title), number=number, repeat=3)) / number
+        print('%15d    %15.1f    %14.1f' % (count, legacy * 1e6, indexed * 1e6))
+
+def legacyConvertBytes(inputstr):
+    # how MessageFormatter.convertBytes worked before, only the first 'nnnbytes' was converted
+    outputstr = inputstr
+    pattern = re.compile(r'\d*bytes')
+    match = pattern.search(inputstr)
+    if match:
+        matchstr = match.group()
+        t = int(matchstr.replace('bytes',''))
+        u = "B"
+        for unit in ('K', 'M', 'G', 'T'):
+            if t>1024:
+                t = t / 1024
+                u = unit
+        if u != "B":
+            t = str(round(t,2))
+        else:
+            t = str(t)
+        outputstr = inputstr.replace(matchstr,t + u)
+    return(outputstr)
+
+def benchConvertBytes():
+    # cost of converting 1000 lines, a report with several byte counts in every line and a mixed one with a byte count in every 5th line
+    reports = {
+        'bytes': ['/dev/sd' + str(i) + ' used 123456789bytes free 98765432101bytes total 99999999999bytes' for i in range(1000)],
+        'mixed': ['/dev/sd' + str(i) + ' used 123456789bytes free 98765432101bytes' if i % 5 == 0 else 'host' + str(i) + ' cpu 93% load high' for i in range(1000)],
+    }
+    formatter = sendmessage.MessageFormatter()
+    number = 20
+    print('lines    legacy, first match only (ms)    every match (ms)')
+    for name,lines in reports.items():
+        legacy = min(timeit.repeat(lambda: [legacyConvertBytes(v) for v in lines], number=number, repeat=3)) / number
+        current = min(timeit.repeat(lambda: [formatter.convertBytes(v) for v in lines], number=number, repeat=3)) / number
+        print('%5s    %29.2f    %16.2f' % (name, legacy * 1e3, current * 1e3))
+
+def importTime(code,number=10):
+    # best wall time (ms) of a fresh interpreter running code, with the startup of the interpreter itself subtracted
+    def run(code):
+        best = None
+        for i in range(number):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            elapsed = time.perf_counter() - started
+            if best is None or elapsed < best:
+                best = elapsed
+        return(best)
+    return((run(code) - run('pass')) * 1e3)
+
+def benchImport():
+    # startup cost of sendmessage, the modules which were imported unconditionally before the channel registry
+    # are imported first to show the cost without lazy imports
+    eager = 'import yaml, smtplib, email.mime.multipart, email.mime.text, email.header, hmac, sqlite3, asyncio, http.server, socketserver'
+    print('import sendmessage (ms)    with eager imports (ms)')
+    print('%23.1f    %23.1f' % (importTime('import sendmessage'), importTime(eager + '; import sendmessage')))
+    # modules loaded for a bark only config
+    code = ('import sys, sendmessage; sendmessage.Dispatcher({"bark": {"endpoint": "http://127.0.0.1/key"}}); '
+        'print(" ".join(m for m in ' + repr(eager[7:].split(', ')) + ' if m in sys.modules) or "none")')
+    modules = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    print('of them loaded for bark only: ' + modules)
+
+def benchConfig():
+    # loading a config with 200 tailoring rules of bark, by parsing yaml and from the snapshot
+    lines = ['bark:', '  endpoint: https://127.0.0.1/key/', '  tailoring:']
+    for i in range(200):
+        lines += ['    - title: ["title %d", ["^host%d .* down$"]]' % (i, i), '      group: "group%d"' % i, '      sound: "bell"']
+    with tempfile.TemporaryDirectory() as folder:
+        configpath = os.path.join(folder, 'config.yml')
+        with open(configpath, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(lines) + '\n')
+        loader = sendmessage.ConfigLoader()
+        number = 20
+        with contextlib.redirect_stdout(io.StringIO()):
+            parsed = min(timeit.repeat(lambda: loader.loadConfig(configpath, snapshot=False), number=number, repeat=3)) / number
+            loader.loadConfig(configpath)
+            snapshot = min(timeit.repeat(lambda: loader.loadConfig(configpath), number=number, repeat=3)) / number
+    print('yaml with validation (ms)    snapshot (ms)')
+    print('%25.2f    %13.2f' % (parsed * 1e3, snapshot * 1e3))
+
+class NullChannel(sendmessage.Channel):
+    # pushes nothing, only the rate limit of 100 messages per second applies
+    configkey = 'null'
+    ratelimit = (100, 1)
+
+    def push(self,config,content):
+        return('ok')
+
+    async def pushAsync(self,config,content):
+        return('ok')
+
+def criticalLatency(priority):
+    # latency of critical messages while 50 threads keep the rate limit of the channel saturated with bulk messages
+    sendmessage.registry.register(NullChannel)
+    dispatcher = sendmessage.Dispatcher({'null': {'ratelimit': {'rate': 100, 'per': 1, 'burst': 10}}, 'priority': priority})
+    stopping = threading.Event()
+    def flood():
+        while not stopping.is_set():
+            dispatcher.dispatch(['bulk', 'line'], 'bulk')
+    threads = [threading.Thread(target=flood, daemon=True) for i in range(50)]
+    for thread in threads:
+        thread.start()
+    time.sleep(1)
+    latencies = []
+    for i in range(20):
+        started = time.monotonic()
+        dispatcher.dispatch(['critical', 'line'], 'critical')
+        latencies.append(time.monotonic() - started)
+        time.sleep(0.1)
+    stopping.set()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return((latencies[len(latencies) // 2], latencies[-1]))
+
+def benchPriority():
+    # critical messages served by priority compared with all the messages in one queue (first come first served)
+    print('queues         median (ms)    max (ms)')
+    for label,priority in (('fifo', {'bulk': 'normal', 'critical': 'normal'}), ('priority', {})):
+        median, worst = criticalLatency(priority)
+        print('%-8s    %14.1f    %8.1f' % (label, median * 1e3, worst * 1e3))
+
+def benchMetrics():
+    # cost of the instrumentation of one push with 4 phases, which is paid by every push
+    sendmessage.metrics.hooks = []
+    def push():
+        timer = sendmessage.metrics.startPush('null')
+        for phase in ('formatting', 'signing', 'connect', 'request'):
+            with sendmessage.metrics.phase(phase):
+                pass
+        sendmessage.metrics.finishPush(timer, 'ok')
+    number = 20000
+    seconds = min(timeit.repeat(push, number=number, repeat=3)) / number
+    print('instrumentation (us/push)')
+    print('%25.1f' % (seconds * 1e6))
+
+def legacyBarkUrl(endpoint,title,body,parameters):
+    # how Bark.buildRequest put the message in the url before it was posted as json
+    url = endpoint + parse.quote_plus(title) + '/' + parse.quote_plus(body)
+    conchar = '?'
+    for k,v in parameters.items():
+        url = url + conchar + k + '=' + parse.quote_plus(str(v))
+        conchar = '&'
+    return(url)
+
+def benchPayload():
+    # bytes on the wire and cost of building the request for a report of 1000 chinese and english chars
+    bark = sendmessage.Bark()
+    config = {'endpoint': 'https://api.day.app/key/', 'group': 'report', 'bodylimit': False}
+    lines = ['磁盘使用率 disk usage 95%'] * 50
+    msg = sendmessage.Message(['报告 report'] + lines)
+    title, body = msg.title, msg.getBody(bark.delimiter)
+    legacy = legacyBarkUrl(config['endpoint'], title, body, {'group': 'report'})
+    req = bark.buildRequest(config, msg)
+    number = 2000
+    get = min(timeit.repeat(lambda: legacyBarkUrl(config['endpoint'], title, body, {'group': 'report'}), number=number, repeat=3)) / number
+    post = min(timeit.repeat(lambda: bark.buildRequest(config, msg), number=number, repeat=3)) / number
+    print('         bytes    build (us)')
+    print('get  %9d    %10.1f' % (len(legacy.encode('utf-8')), get * 1e6))
+    print('post %9d    %10.1f' % (len(req.full_url) + len(req.data), post * 1e6))
+
+benchmarks = {
+    'tailoring': benchTailoring,
+    'convertbytes': benchConvertBytes,
+    'import': benchImport,
+    'config': benchConfig,
+    'priority': benchPriority,
+    'metrics': benchMetrics,
+    'payload': benchPayload,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        print('== ' + name)
+        benchmarks[name]()
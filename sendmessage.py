@@ -20,6 +20,13 @@
 #       python3 sendmessage.py 'title','line 1 in the body', 'line 2 in the body', 'line 3 in the body'[..., 'line x in the body']
 #   3. If your config file is stored somewhere else, try to call as below and make sure --config or -c is the first parameter
 #       python3 sendmessage.py --config='otherconfig.yml' 'title','line 1 in the body', 'line 2 in the body', 'line 3 in the body'[..., 'line x in the body']
+#   4. To run as a daemon and send messages via the daemon
+#       python3 sendmessage.py --config='config.yml' --serve=127.0.0.1:8765
+#       python3 sendmessage.py --daemon=127.0.0.1:8765 'title','line 1 in the body', 'line 2 in the body'[..., 'line x in the body']
+#   5. To retry the failed messages kept in the outbox, if the outbox is configured and no daemon is running
+#       python3 sendmessage.py --config='config.yml' --drain
+#   6. To push many messages in one process, one json message per line from a file or stdin
+#       python3 sendmessage.py --config='config.yml' --stream=messages.jsonl
 # Environment:
 #   This script is developed under python version 3.10.  Ideally it works in most of the python 3.x version but the latest version is always recommended.
 #   Packages that you may need to install if you have not:
@@ -29,7 +36,6 @@
 # The author assumes no responsibility or liability for any errors or omissions in this script.
 #
 
-import yaml # pip3 install pyyaml
 import json, sys
 import os
 from urllib import request
@@ -37,70 +43,231 @@ from urllib import parse
 from urllib.error import URLError, HTTPError
 import ssl
 import re
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.header import Header
 import time
-import hmac
 import hashlib
 import base64
 import getopt
+import concurrent.futures
+import socket
+import http.client
+import threading
+import io
+import atexit
+import random
+import collections
+import weakref
+import importlib
+import marshal
+import contextlib
+import contextvars
+import bisect
+
+class LazyModule():
+    # stands for a module which is imported when one of its attributes is used for the first time,
+    # so that the modules needed only by some channels or modes do not slow down every run
+    def __init__(self,name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self,attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return(getattr(self.module, attr))
+
+yaml = LazyModule('yaml') # pip3 install pyyaml
+smtplib = LazyModule('smtplib')
+mimemultipart = LazyModule('email.mime.multipart')
+mimetext = LazyModule('email.mime.text')
+emailheader = LazyModule('email.header')
+hmac = LazyModule('hmac')
+sqlite3 = LazyModule('sqlite3')
+asyncio = LazyModule('asyncio')
+
+class ConfigError(ValueError):
+    # mistakes in config.yml, found when the config is loaded rather than when a message is pushed
+    pass
 
 class ConfigLoader():
+    #
+    # config.yml is validated once and kept in a snapshot next to it, e.g. .config.yml.snapshot,
+    # later runs load the snapshot without parsing yaml until config.yml is changed
+    #
+    snapshotversion = 1    #snapshots of other versions are ignored
+    numbers = {
+        'dispatcher': ('maxworkers', 'timeout', 'maxinflight'),
+        'transport': ('maxpoolsize', 'idletimeout', 'connecttimeout', 'readtimeout'),
+        'outbox': ('maxattempts', 'basedelay', 'maxdelay'),
+        'dedup': ('ttl', 'maxsize'),
+        'coalesce': ('window', 'maxbodies'),
+        'metrics': ('interval', 'profile'),
+        'ratelimit': (),
+    }
+    switches = {    #numbers which may also be 0 or false to disable
+        'dispatcher': ('reload',),
+    }
 
-    def loadConfig(self,configpath="config.yml"):
-        configpath = configpath.strip()
-        basename = os.path.basename(configpath)
-        if(configpath == basename):
+    def getPath(self,path):
+        # file names without directory are in the same folder as the script
+        path = path.strip()
+        basename = os.path.basename(path)
+        if(path == basename):
             scriptdir = os.path.dirname(sys.argv[0])
-            configpath = os.path.join(scriptdir,configpath)
+            path = os.path.join(scriptdir,path)
+        return(path)
+
+    def loadConfig(self,configpath="config.yml",snapshot=True):
+        configpath = self.getPath(configpath)
         
         print('reading config from: ' + configpath)
     
-        with open(configpath, 'r', encoding='utf-8') as file:
-            config = yaml.safe_load(file)
+        stat = os.stat(configpath)
+        config, data = (None, None)
+        if snapshot:
+            config, data = self.loadSnapshot(configpath, stat)
+        if config is None:
+            if data is None:
+                with open(configpath, 'rb') as file:
+                    data = file.read()
+            config = yaml.safe_load(data.decode('utf-8'))
+            self.validateConfig(config)
+            if snapshot:
+                self.saveSnapshot(configpath, stat, data, config)
     
         return(config)
+
+    def getSnapshotPath(self,configpath):
+        folder, basename = os.path.split(configpath)
+        return(os.path.join(folder, '.' + basename + '.snapshot'))
+
+    def loadSnapshot(self,configpath,stat):
+        # returns (config, data) where config is None if there is no snapshot of the same config.yml,
+        # and data is the content of config.yml if it has been read
+        try:
+            with open(self.getSnapshotPath(configpath), 'rb') as file:
+                version, mtime, size, digest, config = marshal.load(file)
+        except (OSError, EOFError, ValueError, TypeError):
+            return((None, None))
+        if version != self.snapshotversion:
+            return((None, None))
+        if mtime == stat.st_mtime_ns and size == stat.st_size:
+            return((config, None))
+        #modified time is changed, but the content may be the same
+        with open(configpath, 'rb') as file:
+            data = file.read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            return((None, data))
+        self.saveSnapshot(configpath, stat, data, config)
+        return((config, data))
+
+    def saveSnapshot(self,configpath,stat,data,config):
+        snapshotpath = self.getSnapshotPath(configpath)
+        tmppath = snapshotpath + '.' + str(os.getpid()) + '.tmp'
+        try:
+            snapshot = marshal.dumps((self.snapshotversion, stat.st_mtime_ns, stat.st_size, hashlib.sha256(data).hexdigest(), config))
+            #secrets are in the snapshot as well as in config.yml
+            fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as file:
+                file.write(snapshot)
+            os.replace(tmppath, snapshotpath)
+        except (OSError, ValueError):
+            #e.g. the folder is read only, or config.yml has values which can not be kept in a snapshot
+            pass
+
+    def validateConfig(self,config):
+        # raises ConfigError for the first mistake found
+        if not isinstance(config, dict):
+            raise ConfigError('config should be a mapping of channels and settings')
+        for key,section in config.items():
+            channel = registry.get(key)
+            if channel is not None and hasattr(channel, 'validate'):
+                channel.validate(section, key)
+        for key,names in self.numbers.items():
+            section = config.get(key)
+            if section is None:
+                continue
+            if not isinstance(section, dict):
+                raise ConfigError(key + ': settings should be a mapping')
+            for name in names:
+                value = section.get(name)
+                if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+                    raise ConfigError(key + ': ' + name + ' should be a positive number')
+        for key,names in self.switches.items():
+            section = config.get(key) or {}
+            for name in names:
+                value = section.get(name)
+                if value is not None and value is not False and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+                    raise ConfigError(key + ': ' + name + ' should be a positive number, or 0 to disable')
+        priority = config.get('priority')
+        if priority is not None:
+            if not isinstance(priority, dict):
+                raise ConfigError('priority: settings should be a mapping of severities')
+            for severity,value in priority.items():
+                if value not in priorities:
+                    raise ConfigError('priority: ' + str(severity) + ' should be one of ' + ', '.join(priorities))
+        key = (config.get('coalesce') or {}).get('key')
+        if key is not None:
+            try:
+                re.compile(key)
+            except (re.error, TypeError) as ex:
+                raise ConfigError('coalesce: key ' + repr(key) + ' is not a valid regexp: ' + str(ex))
+        routing = config.get('routing')
+        if routing is None:
+            return
+        if not isinstance(routing, list):
+            raise ConfigError('routing: rules should be a list')
+        for i,rule in enumerate(routing):
+            name = 'routing: rule ' + str(i + 1)
+            if not isinstance(rule, dict):
+                raise ConfigError(name + ': rule should be a mapping')
+            validateTitle(rule.get('title'), name)
+            severity = rule.get('severity')
+            if severity is not None and not isinstance(severity, str) and not (isinstance(severity, list) and all(isinstance(v, str) for v in severity)):
+                raise ConfigError(name + ': severity should be a string or a list of strings')
+            channels = rule.get('channels')
+            if channels is not None and not isinstance(channels, (str, list)):
+                raise ConfigError(name + ': channels should be a list')
+            overrides = rule.get('overrides') or {}
+            if not isinstance(overrides, dict):
+                raise ConfigError(name + ': overrides should be a mapping of channels')
+            for service,override in overrides.items():
+                channel = registry.get(service)
+                if channel is None:
+                    raise ConfigError(name + ': ' + str(service) + ' is not a channel')
+                if override is not None and not isinstance(override, dict):
+                    raise ConfigError(name + ': ' + service + ': settings should be a mapping')
+                merged = dict(config.get(service) or {})
+                merged.update(override or {})
+                if hasattr(channel, 'validate'):
+                    channel.validate(merged, name + ': ' + service)
     
 class MessageFormatter():
+    bytespattern = re.compile(r'(\d+)bytes')
+    units = ('B', 'K', 'M', 'G', 'T')
 
     def __init__(self):
         self.rounddigit = 2
-    
+
+    def formatBytes(self,size):
+        # a unit is used only if the size is larger than 1024 of it, e.g. 1024 -> 1024B, 1025 -> 1.0K
+        if size <= 1024:
+            return(str(size) + 'B')
+        u = min(((size - 1).bit_length() - 1) // 10, 4)
+        return(str(round(size / (1 << (10 * u)), self.rounddigit)) + self.units[u])
+
+    def replaceBytes(self,match):
+        return(self.formatBytes(int(match.group(1))))
+
     def convertBytes(self,inputstr):
         # convert size in bytes into readable format
         # criteria
         # 1. only if 'nnnnnnnnnnnbytes' is in the string, where 'nnnnnnnnnnn' is integer
         # 2. be careful that there is no space in between the 'nnnnnnnnnnn' and 'bytes'
         # 3. be careful that it is 'bytes', not 'byte/Byte/Bytes/BYTE/BYTES'.
-        outputstr = inputstr
-        pattern = re.compile(r'\d*bytes')
-        match = pattern.search(inputstr)
-        if match:
-            matchstr = match.group()
-            size = int(matchstr.replace('bytes',''))
-            t = size
-            u = "B"
-            if t>1024:
-                t = t / 1024
-                u = "K"
-            if t>1024:
-                t = t / 1024
-                u = 'M'
-            if t>1024:
-                t = t / 1024
-                u = "G"
-            if t>1024:
-                t = t / 1024
-                u = "T"
-            if u != "B":
-                t = str(round(t,self.rounddigit))
-            else:
-                t = str(t)
-            replacestr = t + u
-            outputstr = inputstr.replace(matchstr,replacestr)
-        return(outputstr)
+        # 4. every 'nnnnnnnnnnnbytes' in the string is converted
+        if 'bytes' not in inputstr:
+            #most lines have no byte count, the substring test is cheaper than the regexp
+            return(inputstr)
+        return(self.bytespattern.sub(self.replaceBytes, inputstr))
 
     def getHostLocation(self,inputstr):
         outputstr = inputstr
@@ -109,31 +276,1283 @@ class MessageFormatter():
             outputstr = parsedurl.netloc
         return(outputstr)
 
+def getTextSize(text,unit):
+    # size of text in chars, bytes (utf-8), json (escaped in a json string) or url (percent-encoded)
+    if unit == 'bytes':
+        return(len(text.encode('utf-8')))
+    if unit == 'json':
+        return(len(json.dumps(text)) - 2)
+    if unit == 'url':
+        return(len(parse.quote(text)))
+    return(len(text))
+
+class Message():
+    #
+    # title and formatted body lines of one message, shared by all the channels
+    # bodies are built once for each delimiter and length limit
+    # long messages are split into parts for the limits of the providers, with the titles numbered e.g. 'title (1/3)',
+    # basetitle is the title before numbering
+    # priority is one of low, normal, high and critical, set by the dispatcher from the severity
+    # attempts counts the deliveries of the message, more than 1 when it is retried from the outbox
+    # firstpart is the index of the first part not delivered yet, the parts before it are skipped when it is retried
+    #
+    priority = 'normal'
+    attempts = 1
+    firstpart = 0
+
+    def __init__(self,content):
+        self.content = list(content)
+        if(len(content)<2):
+            self.title = "参数个数不对!"
+            self.lines = None
+        else:
+            self.title = content[0]
+            with metrics.phase('formatting'):
+                formatter = MessageFormatter()
+                self.lines = [formatter.getHostLocation(formatter.convertBytes(v)) for v in content[1:]]
+        self.basetitle = self.title
+        self.bodies = {}
+        self.parts = {}
+
+    @classmethod
+    def fromContent(cls,content):
+        # content is either a Message or a list of [title, line 1, line 2, ...]
+        if isinstance(content, Message):
+            return(content)
+        return(cls(content))
+
+    def getBody(self,delimiter,limit=None):
+        key = (delimiter, limit)
+        body = self.bodies.get(key)
+        if body is None:
+            with metrics.phase('formatting'):
+                if self.lines is None:
+                    body = "null"
+                else:
+                    body = delimiter.join(self.lines) + delimiter
+                if limit is not None and len(body) > limit:
+                    body = body[0:limit]
+            self.bodies[key] = body
+        return(body)
+
+    def cutLine(self,line,limit,unit):
+        # returns pieces of a line longer than limit, cut at a space in the second half of each piece if there is one
+        pieces = []
+        while getTextSize(line, unit) > limit:
+            if unit == 'chars':
+                end = limit
+            else:
+                #chars are never cut in half, whatever their size in the unit is
+                end = 0
+                size = 0
+                while end < len(line):
+                    size = size + getTextSize(line[end], unit)
+                    if size > limit:
+                        break
+                    end = end + 1
+            space = line.rfind(' ', end // 2, end)
+            if space > 0:
+                end = space + 1
+            pieces.append(line[0:max(1, end)])
+            line = line[max(1, end):]
+        pieces.append(line)
+        return(pieces)
+
+    def getParts(self,delimiter,limit,unit='chars'):
+        # returns [Message, ...] of at most limit of unit each for title and body, the body is split along lines,
+        # the message itself if it fits
+        key = (delimiter, limit, unit)
+        parts = self.parts.get(key)
+        if parts is not None:
+            return(parts)
+        #room for the markup of the channels and the numbers of the parts
+        available = max(limit // 2, limit - getTextSize(self.title, unit) - 32)
+        if self.lines is None or getTextSize(self.getBody(delimiter), unit) <= available:
+            self.parts[key] = [self]
+            return([self])
+        with metrics.phase('formatting'):
+            delimitersize = getTextSize(delimiter, unit)
+            groups = []
+            group = []
+            used = 0
+            for line in self.lines:
+                for piece in self.cutLine(line, available - delimitersize, unit):
+                    size = getTextSize(piece, unit) + delimitersize
+                    if len(group) > 0 and used + size > available:
+                        groups.append(group)
+                        group = []
+                        used = 0
+                    group.append(piece)
+                    used = used + size
+            groups.append(group)
+            parts = []
+            for i,group in enumerate(groups):
+                part = Message.__new__(Message)
+                part.content = self.content
+                part.title = self.title + ' (' + str(i + 1) + '/' + str(len(groups)) + ')'
+                part.basetitle = self.basetitle
+                part.lines = group
+                part.bodies = {}
+                part.parts = {}
+                part.priority = self.priority
+                part.attempts = self.attempts
+                parts.append(part)
+        self.parts[key] = parts
+        return(parts)
+
+#
+# Metrics
+#
+currentpush = contextvars.ContextVar('currentpush', default=None)
+
+class PushTimer():
+    # one push of a channel, phases are kept in currentpush while it runs
+
+    def __init__(self,channel):
+        self.channel = channel
+        self.phases = {}
+        self.started = time.perf_counter()
+        self.token = currentpush.set(self)
+
+class Metrics():
+    #
+    # latency histograms, counters and gauges of the pushes in prometheus text format
+    # optional settings in config.yml:
+    #   metrics:
+    #     path: metrics.prom    #optional, written for the textfile collector of node_exporter
+    #     interval: 15    #optional, seconds between writes of the daemon
+    #     profile: 2    #optional, pushes slower than this (in seconds) are logged to stderr with the time of each phase
+    # the daemon serves them at http://127.0.0.1:8765/metrics as well
+    # hooks are called with (channel, seconds, phases, resp) after every push, e.g. to find slow providers:
+    #   sendmessage.metrics.hooks.append(lambda channel, seconds, phases, resp: print(channel, seconds, phases))
+    #
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    descriptions = {
+        'sendmessage_push_seconds': ('histogram', 'Time to push a message to a channel, without waiting for rate limits'),
+        'sendmessage_phase_seconds': ('histogram', 'Time spent in each phase of pushing messages'),
+        'sendmessage_pushes_total': ('counter', 'Messages pushed to each channel by result'),
+        'sendmessage_timeouts_total': ('counter', 'Pushes which did not finish within the timeout of the dispatcher'),
+        'sendmessage_retries_total': ('counter', 'Messages retried from the outbox'),
+        'sendmessage_outbox_messages': ('gauge', 'Messages in the outbox waiting for delivery or dead'),
+        'sendmessage_ratelimit_waiting': ('gauge', 'Messages waiting for the rate limit of a channel'),
+        'sendmessage_circuit_open': ('gauge', 'Endpoints whose circuit breaker is not closed'),
+    }
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}    #(name, labels) -> [count of each bucket, ..., count above buckets, sum]
+        self.counters = {}
+        self.gauges = {}
+        self.hooks = []
+        self.profile = None
+
+    def configure(self,settings):
+        self.profile = settings.get('profile')
+
+    def observe(self,name,labels,value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = [0] * (len(self.buckets) + 2)
+                self.histograms[(name, labels)] = histogram
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def increment(self,name,labels,value=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def setGauges(self,name,values):
+        # values are {labels: value}, gauges of the name which are not given any more are removed
+        with self.lock:
+            for key in [key for key in self.gauges if key[0] == name]:
+                del self.gauges[key]
+            for labels,value in values.items():
+                self.gauges[(name, labels)] = value
+
+    @contextlib.contextmanager
+    def phase(self,name):
+        # time a phase of pushing, e.g. formatting, signing, token, connect or request
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            timer = currentpush.get()
+            if timer is None:
+                #e.g. formatting before the message goes to the channels
+                self.observe('sendmessage_phase_seconds', (('phase', name),), elapsed)
+            else:
+                timer.phases[name] = timer.phases.get(name, 0) + elapsed
+                self.observe('sendmessage_phase_seconds', (('channel', timer.channel), ('phase', name)), elapsed)
+
+    def getResult(self,resp):
+        # result of a push for the counters, e.g. ok, http_error or timeout
+        if isinstance(resp, list):
+            resp = ([r for r in resp if isFailure(r)] or [None])[0]
+        return(SendResult.fromValue(resp).status)
+
+    def count(self,channel,resp):
+        self.increment('sendmessage_pushes_total', (('channel', channel), ('result', self.getResult(resp))))
+
+    def startPush(self,channel):
+        # returns the timer to give to finishPush, phases of the push in the same thread or task are kept in it
+        return(PushTimer(channel))
+
+    def finishPush(self,timer,resp):
+        elapsed = time.perf_counter() - timer.started
+        currentpush.reset(timer.token)
+        self.observe('sendmessage_push_seconds', (('channel', timer.channel),), elapsed)
+        self.count(timer.channel, resp)
+        if self.profile is not None and elapsed >= self.profile:
+            phases = ', '.join(name + ' ' + str(round(seconds, 3)) for name,seconds in timer.phases.items())
+            #one write for each line, pushes of several threads may be logged at the same time
+            sys.stderr.write('slow push: ' + timer.channel + ' ' + str(round(elapsed, 3)) + 's (' + phases + ')\n')
+        for hook in self.hooks:
+            try:
+                hook(timer.channel, elapsed, timer.phases, resp)
+            except Exception as e:
+                print('metrics hook: ' + repr(e), file=sys.stderr)
+
+    def formatLabels(self,labels):
+        if len(labels) == 0:
+            return('')
+        values = []
+        for k,v in labels:
+            v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            values.append(k + '="' + v + '"')
+        return('{' + ','.join(values) + '}')
+
+    def render(self):
+        # returns the metrics in prometheus text format
+        with self.lock:
+            items = {}
+            for (name,labels),histogram in self.histograms.items():
+                items.setdefault(name, []).append((labels, list(histogram)))
+            for (name,labels),value in list(self.counters.items()) + list(self.gauges.items()):
+                items.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(items):
+            kind, description = self.descriptions.get(name, ('untyped', name))
+            lines.append('# HELP ' + name + ' ' + description)
+            lines.append('# TYPE ' + name + ' ' + kind)
+            for labels,value in sorted(items[name]):
+                if kind != 'histogram':
+                    lines.append(name + self.formatLabels(labels) + ' ' + str(value))
+                    continue
+                count = 0
+                for bound,n in zip(self.buckets + ('+Inf',), value[:-1]):
+                    count += n
+                    lines.append(name + '_bucket' + self.formatLabels(labels + (('le', str(bound)),)) + ' ' + str(count))
+                lines.append(name + '_sum' + self.formatLabels(labels) + ' ' + repr(value[-1]))
+                lines.append(name + '_count' + self.formatLabels(labels) + ' ' + str(count))
+        return('\n'.join(lines) + '\n')
+
+    def write(self,path,text):
+        # replace the file at once, so that the collector never reads half of it
+        tmppath = path + '.tmp'
+        with open(tmppath, 'w', encoding='utf-8') as file:
+            file.write(text)
+        os.replace(tmppath, path)
+
+metrics = Metrics()
+
+#
+# HTTP transport
+#
+class PooledHTTPConnection(http.client.HTTPConnection):
+    # http connection with one timeout for connecting and another one for reading responses
+
+    def __init__(self,host,port=None,timeout=socket._GLOBAL_DEFAULT_TIMEOUT,readtimeout=None):
+        super().__init__(host, port, timeout=timeout)
+        self.readtimeout = readtimeout
+
+    def connect(self):
+        super().connect()
+        self.sock.settimeout(self.readtimeout)
+
+class PooledHTTPSConnection(http.client.HTTPSConnection):
+    # https connection which resumes the tls session of previous connections to the same host
+
+    def __init__(self,host,port=None,timeout=socket._GLOBAL_DEFAULT_TIMEOUT,context=None,tlssession=None,readtimeout=None):
+        super().__init__(host, port, timeout=timeout, context=context)
+        self.tlssession = tlssession
+        self.readtimeout = readtimeout
+
+    def connect(self):
+        #the tls handshake is part of connecting
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host, session=self.tlssession)
+        self.sock.settimeout(self.readtimeout)
+
+class TransportResponse():
+    # fully read response, so that the connection can go back to the pool at once
+
+    def __init__(self,url,status,reason,headers,data):
+        self.url = url
+        self.status = status
+        self.code = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+
+    def read(self):
+        return(self.data)
+
+    def getcode(self):
+        return(self.status)
+
+    def geturl(self):
+        return(self.url)
+
+class HttpTransport():
+    #
+    # keep-alive connection pools per host shared by all the channels
+    # optional settings in config.yml:
+    #   transport:
+    #     maxpoolsize: 4    #max number of idle connections kept for each host
+    #     idletimeout: 60    #idle connections older than this (in seconds) are closed
+    #     connecttimeout: 5    #max seconds to connect to the server
+    #     readtimeout: 15    #max seconds to wait for data from the server
+    #
+    def __init__(self,maxpoolsize=4,idletimeout=60,connecttimeout=5,readtimeout=15):
+        self.maxpoolsize = maxpoolsize
+        self.idletimeout = idletimeout
+        self.connecttimeout = connecttimeout
+        self.readtimeout = readtimeout
+        self.pools = {}
+        self.tlssessions = {}
+        self.lock = threading.Lock()
+        self.proxies = request.getproxies()
+        self.useragent = 'Python-urllib/%d.%d' % sys.version_info[:2]
+        self.contexts = {}
+
+    def configure(self,settings):
+        self.maxpoolsize = settings.get('maxpoolsize', self.maxpoolsize)
+        self.idletimeout = settings.get('idletimeout', self.idletimeout)
+        self.connecttimeout = settings.get('connecttimeout', self.connecttimeout)
+        self.readtimeout = settings.get('readtimeout', self.readtimeout)
+
+    def getTimeouts(self,timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        # returns (connecttimeout, readtimeout), a timeout given by the caller is used for both
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            return((self.connecttimeout, self.readtimeout))
+        return((timeout, timeout))
+
+    def getContext(self,verify):
+        with self.lock:
+            if verify not in self.contexts:
+                if verify:
+                    self.contexts[verify] = ssl.create_default_context()
+                else:
+                    self.contexts[verify] = ssl._create_unverified_context()
+            return(self.contexts[verify])
+
+    def acquire(self,key,timeout):
+        # returns (connection, reused)
+        scheme, host, port, verify = key
+        connecttimeout, readtimeout = self.getTimeouts(timeout)
+        now = time.monotonic()
+        with self.lock:
+            pool = self.pools.get(key, [])
+            while pool:
+                conn, lastused = pool.pop()
+                if now - lastused < self.idletimeout:
+                    if conn.sock is not None:
+                        conn.sock.settimeout(readtimeout)
+                    conn.timeout = connecttimeout
+                    conn.readtimeout = readtimeout
+                    return((conn, True))
+                conn.close()
+            tlssession = self.tlssessions.get(key)
+        if scheme == 'https':
+            conn = PooledHTTPSConnection(host, port, timeout=connecttimeout, context=self.getContext(verify), tlssession=tlssession, readtimeout=readtimeout)
+        else:
+            conn = PooledHTTPConnection(host, port, timeout=connecttimeout, readtimeout=readtimeout)
+        return((conn, False))
+
+    def release(self,key,conn):
+        if isinstance(conn.sock, ssl.SSLSocket) and conn.sock.session is not None:
+            self.tlssessions[key] = conn.sock.session
+        with self.lock:
+            pool = self.pools.setdefault(key, [])
+            if len(pool) < self.maxpoolsize:
+                pool.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def closeAll(self):
+        with self.lock:
+            for pool in self.pools.values():
+                for conn, lastused in pool:
+                    conn.close()
+            self.pools = {}
+
+    def useProxy(self,scheme,host):
+        return(scheme in self.proxies and not request.proxy_bypass(host))
+
+    def prepareRequest(self,req):
+        # returns (url, method, body, headers) of request.Request or url
+        if isinstance(req, str):
+            req = request.Request(req)
+        body = req.data
+        headers = {'User-Agent': self.useragent}
+        headers.update(req.header_items())
+        if body is not None and 'Content-type' not in headers:
+            headers['Content-type'] = 'application/x-www-form-urlencoded'
+        return((req.full_url, req.get_method(), body, headers))
+
+    def getKey(self,parsedurl,verify):
+        # returns (key, path) where key identifies the pool of connections
+        path = parsedurl.path or '/'
+        if parsedurl.query:
+            path = path + '?' + parsedurl.query
+        return(((parsedurl.scheme, parsedurl.hostname, parsedurl.port, verify), path))
+
+    def getRedirect(self,url,status,respheaders,method,body,headers):
+        # returns (url, method, body) to follow, or None
+        location = respheaders.get('Location')
+        if status not in (301, 302, 303, 307, 308) or location is None:
+            return(None)
+        if status == 303 or (status in (301, 302) and method == 'POST'):
+            method = 'GET'
+            body = None
+            headers.pop('Content-type', None)
+        return((parse.urljoin(url, location), method, body))
+
+    def isDirect(self,url):
+        # False if the request should go via urllib, for proxies and other schemes
+        parsedurl = parse.urlsplit(url)
+        return(parsedurl.scheme in ('http', 'https') and not self.useProxy(parsedurl.scheme, parsedurl.hostname))
+
+    def urlopen(self,req,timeout=socket._GLOBAL_DEFAULT_TIMEOUT,verify=True):
+        # drop-in replacement of request.urlopen for the channels
+        # raises HTTPError for http status >= 400 and URLError for connection problems
+        url, method, body, headers = self.prepareRequest(req)
+        if not self.isDirect(url):
+            #urllib has one timeout for connecting and reading
+            timeout = self.getTimeouts(timeout)[1]
+            with metrics.phase('request'):
+                if verify:
+                    return(request.urlopen(req, timeout=timeout))
+                return(request.urlopen(req, timeout=timeout, context=self.getContext(verify)))
+
+        for redirect in range(6):
+            key, path = self.getKey(parse.urlsplit(url), verify)
+            status, reason, respheaders, data = self.send(key, method, path, body, headers, timeout)
+            follow = self.getRedirect(url, status, respheaders, method, body, headers)
+            if follow is None or redirect == 5:
+                break
+            url, method, body = follow
+        if status >= 400:
+            raise HTTPError(url, status, reason, respheaders, io.BytesIO(data))
+        return(TransportResponse(url, status, reason, respheaders, data))
+
+    def send(self,key,method,path,body,headers,timeout):
+        # returns (status, reason, headers, data)
+        while True:
+            conn, reused = self.acquire(key, timeout)
+            try:
+                if conn.sock is None:
+                    with metrics.phase('connect'):
+                        conn.connect()
+                with metrics.phase('request'):
+                    conn.request(method, path, body=body, headers=headers)
+                    resp = conn.getresponse()
+                    data = resp.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+                conn.close()
+                if reused:
+                    #the server has closed the idle connection, try again with a new one
+                    continue
+                raise URLError(e)
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise URLError(e)
+            if resp.will_close:
+                conn.close()
+            else:
+                self.release(key, conn)
+            return((resp.status, resp.reason, resp.headers, data))
+
+transport = HttpTransport()
+
+class AsyncHttpTransport():
+    #
+    # keep-alive connection pools per host for asyncio, one for each event loop
+    # settings and helpers are shared with the blocking transport
+    #
+    def __init__(self,transport):
+        self.transport = transport
+        self.pools = {}
+
+    async def acquire(self,key,connecttimeout=None):
+        # returns (reader, writer, reused)
+        scheme, host, port, verify = key
+        pool = self.pools.get(key, [])
+        now = time.monotonic()
+        while pool:
+            reader, writer, lastused = pool.pop()
+            if now - lastused < self.transport.idletimeout and not writer.is_closing() and not reader.at_eof():
+                return((reader, writer, True))
+            writer.close()
+        with metrics.phase('connect'):
+            if scheme == 'https':
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port or 443, ssl=self.transport.getContext(verify), server_hostname=host), connecttimeout)
+            else:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port or 80), connecttimeout)
+        return((reader, writer, False))
+
+    def release(self,key,reader,writer):
+        pool = self.pools.setdefault(key, [])
+        if len(pool) < self.transport.maxpoolsize:
+            pool.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    def closeAll(self):
+        for pool in self.pools.values():
+            for reader, writer, lastused in pool:
+                writer.close()
+        self.pools = {}
+
+    async def readBody(self,reader,method,status,headers):
+        # returns (data, willclose)
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            return((b'', False))
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            #trailers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            return((b''.join(chunks), False))
+        length = headers.get('Content-Length')
+        if length is not None:
+            return((await reader.readexactly(int(length)), False))
+        return((await reader.read(), True))
+
+    async def exchange(self,reader,writer,method,host,path,body,headers):
+        # returns (status, reason, headers, data, willclose)
+        head = [method + ' ' + path + ' HTTP/1.1', 'Host: ' + host]
+        for k,v in headers.items():
+            head.append(k + ': ' + str(v))
+        if body is not None:
+            head.append('Content-Length: ' + str(len(body)))
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        await writer.drain()
+        while True:
+            statusline = await reader.readline()
+            if not statusline:
+                raise http.client.RemoteDisconnected('Remote end closed connection without response')
+            parts = statusline.decode('latin-1').rstrip('\r\n').split(' ', 2)
+            if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+                raise http.client.BadStatusLine(statusline)
+            status = int(parts[1])
+            reason = parts[2] if len(parts) > 2 else ''
+            lines = []
+            while True:
+                line = await reader.readline()
+                lines.append(line)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            respheaders = http.client.parse_headers(io.BytesIO(b''.join(lines)))
+            if status != 100:
+                break
+        data, willclose = await self.readBody(reader, method, status, respheaders)
+        if respheaders.get('Connection', '').lower() == 'close' or parts[0] == 'HTTP/1.0':
+            willclose = True
+        return((status, reason, respheaders, data, willclose))
+
+    async def send(self,key,host,method,path,body,headers,connecttimeout=None,readtimeout=None):
+        # returns (status, reason, headers, data)
+        while True:
+            try:
+                reader, writer, reused = await self.acquire(key, connecttimeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise URLError(e)
+            try:
+                with metrics.phase('request'):
+                    status, reason, respheaders, data, willclose = await asyncio.wait_for(self.exchange(reader, writer, method, host, path, body, headers), readtimeout)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError) as e:
+                writer.close()
+                if reused:
+                    #the server has closed the idle connection, try again with a new one
+                    continue
+                raise URLError(e)
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                writer.close()
+                raise URLError(e)
+            except BaseException:
+                #e.g. cancelled by timeout, the connection is in unknown state
+                writer.close()
+                raise
+            if willclose:
+                writer.close()
+            else:
+                self.release(key, reader, writer)
+            return((status, reason, respheaders, data))
+
+    async def urlopen(self,req,timeout=socket._GLOBAL_DEFAULT_TIMEOUT,verify=True):
+        # same as HttpTransport.urlopen without blocking the event loop
+        url, method, body, headers = self.transport.prepareRequest(req)
+        if not self.transport.isDirect(url):
+            loop = asyncio.get_running_loop()
+            return(await loop.run_in_executor(None, contextvars.copy_context().run, self.transport.urlopen, req, timeout, verify))
+
+        connecttimeout, readtimeout = self.transport.getTimeouts(timeout)
+        for redirect in range(6):
+            parsedurl = parse.urlsplit(url)
+            key, path = self.transport.getKey(parsedurl, verify)
+            try:
+                status, reason, respheaders, data = await self.send(key, parsedurl.netloc, method, path, body, headers, connecttimeout, readtimeout)
+            except asyncio.TimeoutError as e:
+                raise URLError(e)
+            follow = self.transport.getRedirect(url, status, respheaders, method, body, headers)
+            if follow is None or redirect == 5:
+                break
+            url, method, body = follow
+        if status >= 400:
+            raise HTTPError(url, status, reason, respheaders, io.BytesIO(data))
+        return(TransportResponse(url, status, reason, respheaders, data))
+
+asynctransports = weakref.WeakKeyDictionary()
+
+def getAsyncTransport():
+    # the transport of the running event loop
+    loop = asyncio.get_running_loop()
+    asynctransport = asynctransports.get(loop)
+    if asynctransport is None:
+        asynctransport = AsyncHttpTransport(transport)
+        asynctransports[loop] = asynctransport
+    return(asynctransport)
+
+#
+# Access token cache
+#
+class TokenCache():
+    #
+    # access tokens shared by all messages, refreshed a bit ahead of expiry
+    # tokens can also be kept in a file so that they are shared by short-lived processes
+    #
+    def __init__(self,path=None,margin=300):
+        self.path = path
+        self.margin = margin
+        self.tokens = {}
+        self.locks = {}
+        self.asynclocks = weakref.WeakKeyDictionary()    #locks for each event loop
+        self.lock = threading.Lock()
+        if path is not None:
+            self.tokens = self.loadFile()
+
+    def hashKey(self,key):
+        #secrets are not kept in the cache file in plain text
+        return(hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest())
+
+    def loadFile(self):
+        # a file which is not a cache of tokens, e.g. written by hand or by another program, is ignored
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                tokens = json.load(file)
+        except (OSError, ValueError):
+            return({})
+        if not isinstance(tokens, dict):
+            return({})
+        return({k: v for k,v in tokens.items() if isinstance(v, dict) and isinstance(v.get('token'), str) and isinstance(v.get('expires'), (int, float))})
+
+    def saveFile(self):
+        tmppath = self.path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(self.tokens, file)
+            os.replace(tmppath, self.path)
+        except OSError:
+            pass
+
+    def lookup(self,hashkey):
+        entry = self.tokens.get(hashkey)
+        if entry is not None and time.time() < entry['expires'] - self.margin:
+            return(entry['token'])
+        return(None)
+
+    def store(self,hashkey,token,expires_in):
+        self.tokens[hashkey] = {'token': token, 'expires': time.time() + int(expires_in)}
+        if self.path is not None:
+            self.saveFile()
+
+    def get(self,key,fetch,rejected=None):
+        # fetch() returns (token, expires_in) and is called by one thread at a time for the same key
+        # rejected is the token refused by the server, it will not be returned again
+        hashkey = self.hashKey(key)
+        token = self.lookup(hashkey)
+        if token is not None and token != rejected:
+            return(token)
+        with self.lock:
+            keylock = self.locks.setdefault(hashkey, threading.Lock())
+        with keylock:
+            if self.path is not None:
+                #another process may have refreshed the token
+                self.tokens.update(self.loadFile())
+            token = self.lookup(hashkey)
+            if token is not None and token != rejected:
+                return(token)
+            token, expires_in = fetch()
+            self.store(hashkey, token, expires_in)
+            return(token)
+
+    async def getAsync(self,key,fetch,rejected=None):
+        # same as get, fetch() is a coroutine function called by one task at a time for the same key
+        hashkey = self.hashKey(key)
+        token = self.lookup(hashkey)
+        if token is not None and token != rejected:
+            return(token)
+        with self.lock:
+            keylock = self.asynclocks.setdefault(asyncio.get_running_loop(), {}).setdefault(hashkey, asyncio.Lock())
+        async with keylock:
+            loop = asyncio.get_running_loop()
+            if self.path is not None:
+                #another process may have refreshed the token, the file is read and written off the event loop
+                self.tokens.update(await loop.run_in_executor(None, self.loadFile))
+            token = self.lookup(hashkey)
+            if token is not None and token != rejected:
+                return(token)
+            token, expires_in = await fetch()
+            await loop.run_in_executor(None, self.store, hashkey, token, expires_in)
+            return(token)
+
+tokencaches = {}
+tokencacheslock = threading.Lock()
+
+def getTokenCache(path=None):
+    with tokencacheslock:
+        if path not in tokencaches:
+            tokencaches[path] = TokenCache(path)
+        return(tokencaches[path])
+
+#
+# Tailoring rules
+#
+class TailoringIndex():
+    #
+    # find the first rule whose title matches, rules are in the same format as 'tailoring' of bark
+    #   title: "exact title"
+    #   title: ["exact title 1", "exact title 2", ["regexp 1", "regexp 2"]]
+    # exact titles are looked up in a dict, regexps are combined into one pattern
+    # rules without title match any title only if untitled is True
+    #
+    def __init__(self,rules,untitled=False):
+        self.rules = list(rules or [])
+        self.exact = {}
+        self.patterns = []
+        self.catchall = None
+        for i,rule in enumerate(self.rules):
+            t_title = rule.get('title')
+            if t_title is None and untitled and self.catchall is None:
+                self.catchall = i
+            if isinstance(t_title, str):
+                self.exact.setdefault(t_title, i)
+            if isinstance(t_title, list):
+                for e in t_title:
+                    if isinstance(e, str):
+                        self.exact.setdefault(e, i)
+                    if isinstance(e, list):
+                        #list inside a list for regexp
+                        for r in e:
+                            self.patterns.append((i, r))
+        self.combined = None
+        self.compiled = []
+        self.groups = {}
+        if len(self.patterns) > 0:
+            self.compile()
+
+    def compile(self):
+        self.compiled = [(i, re.compile(r)) for i,r in self.patterns]
+        #backreferences can not be renumbered in a combined pattern, match them one by one instead
+        for i,r in self.patterns:
+            if re.search(r'\\[1-9]|\(\?P=|\(\?\(', r):
+                return
+        #each alternative searches the whole title by a lookahead, so the first rule in order wins
+        alternatives = []
+        for k,(i,r) in enumerate(self.patterns):
+            name = '_tailoring' + str(k)
+            self.groups[name] = i
+            alternatives.append('(?=(?s:.*?)(?:' + r + '))(?P<' + name + '>)')
+        try:
+            self.combined = re.compile('|'.join(alternatives))
+        except re.error:
+            #e.g. inline global flags, fall back to one by one
+            self.combined = None
+
+    def matchIndex(self,title):
+        # returns the index of the first matching rule or None
+        found = self.exact.get(title)
+        if self.catchall is not None and (found is None or self.catchall < found):
+            found = self.catchall
+        if self.combined is not None:
+            m = self.combined.match(title)
+            if m is not None:
+                i = self.groups[m.lastgroup]
+                if found is None or i < found:
+                    found = i
+        else:
+            for i,ptn in self.compiled:
+                if found is not None and i >= found:
+                    break
+                if ptn.search(title):
+                    found = i
+                    break
+        return(found)
+
+    def match(self,title):
+        # returns the first matching rule or None
+        i = self.matchIndex(title)
+        if i is None:
+            return(None)
+        return(self.rules[i])
+
+def validateTitle(t_title,name):
+    # raises ConfigError if title of a rule is not in the format of TailoringIndex, e.g. an invalid regexp
+    if t_title is not None and not isinstance(t_title, (str, list)):
+        raise ConfigError(name + ': title should be a string or a list')
+    for e in (t_title if isinstance(t_title, list) else []):
+        for r in (e if isinstance(e, list) else []):
+            try:
+                re.compile(r)
+            except (re.error, TypeError) as ex:
+                raise ConfigError(name + ': ' + repr(r) + ' is not a valid regexp: ' + str(ex))
+
+#
+# Routing rules
+#
+class Router():
+    #
+    # choose channels and channel settings by message title and severity, the first matching rule wins
+    #   routing:
+    #     - title: ["example title", ["^regexp"]]    #optional, same format as 'tailoring' of bark
+    #       severity: [critical, warning]    #optional
+    #       channels: [dingtalk, wxbot]    #optional, all configured channels if omitted
+    #       overrides:    #optional, settings replacing those of the channel
+    #         dingtalk:
+    #           url: <another-webhook-url>
+    # messages matching no rule go to all configured channels
+    #
+    def __init__(self,rules,config):
+        self.rules = list(rules or [])
+        #channel settings with overrides are merged once rather than for every message
+        self.configs = []
+        for rule in self.rules:
+            merged = {}
+            for service,override in (rule.get('overrides') or {}).items():
+                merged[service] = dict(config.get(service) or {})
+                merged[service].update(override or {})
+            self.configs.append(merged)
+        #severities named by the rules, any other severity is matched by the rules without severity only
+        self.severities = set()
+        for rule in self.rules:
+            self.severities.update(v for v in (self.getSeverities(rule) or []) if isinstance(v, str))
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def getSeverities(self,rule):
+        # severities of a rule as a list, None if the rule applies to all severities
+        r_severity = rule.get('severity')
+        if r_severity is None or isinstance(r_severity, list):
+            return(r_severity)
+        return([r_severity])
+
+    def getIndex(self,severity):
+        # one index for each severity named by the rules, holding the rules which apply to it,
+        # and one for all the other severities, so that the number of indexes does not grow with the messages
+        if severity not in self.severities:
+            severity = None
+        index = self.indexes.get(severity)
+        if index is None:
+            rules = []
+            for i,rule in enumerate(self.rules):
+                r_severity = self.getSeverities(rule)
+                if r_severity is None or severity in r_severity:
+                    rules.append(dict(rule, _routingindex=i))
+            index = TailoringIndex(rules, untitled=True)
+            with self.lock:
+                self.indexes[severity] = index
+        return(index)
+
+    def route(self,title,severity=None):
+        # returns (channels, configs) of the first matching rule
+        # channels is None for all channels, configs holds the channel settings with overrides
+        if len(self.rules) == 0:
+            return((None, {}))
+        rule = self.getIndex(severity).match(title)
+        if rule is None:
+            return((None, {}))
+        channels = rule.get('channels')
+        if isinstance(channels, str):
+            channels = [channels]
+        return((channels, self.configs[rule['_routingindex']]))
+
+#
+# Send results
+#
+class SendResult():
+    #
+    # result of the delivery of one message to one endpoint
+    # status is one of ok, http_error, network_error, provider_error, refused, timeout, exception,
+    # circuit_open, deferred, duplicate and not_configured
+    # code is the http status or the error code of the provider, e.g. errcode of DingTalk,
+    # transient is True for failures which may go away when retried, e.g. network errors rather than wrong settings
+    # latency (seconds), attempts and endpoint are filled in by the dispatcher
+    # part is the index of the part of a long message which has failed, the parts before it are delivered
+    #
+    __slots__ = ('status', 'code', 'message', 'response', 'transient', 'latency', 'attempts', 'endpoint', 'part')
+
+    prefixes = {    #results of channels which return tuples, e.g. channels of other packages
+        'Error code: ': 'http_error',
+        'Reason: ': 'network_error',
+        'Refused: ': 'refused',
+        'Timeout: ': 'timeout',
+        'Exception: ': 'exception',
+        'Circuit open: ': 'circuit_open',
+        'Deferred: ': 'deferred',
+        'Duplicate: ': 'duplicate',
+    }
+    transientstatuses = ('network_error', 'timeout', 'exception', 'circuit_open', 'deferred')
+
+    def __init__(self,status,code=None,message=None,response=None,transient=None):
+        self.status = status
+        self.code = code
+        self.message = message
+        self.response = response
+        if transient is None:
+            transient = status in self.transientstatuses or (status == 'http_error' and isinstance(code, int) and (code == 429 or code >= 500))
+        self.transient = transient
+        self.latency = None
+        self.attempts = 1
+        self.endpoint = None
+        self.part = None
+
+    @property
+    def ok(self):
+        return(self.status == 'ok')
+
+    @classmethod
+    def fromValue(cls,value):
+        # value is a SendResult, an exception, or a string or tuple returned by channels of other packages
+        if isinstance(value, SendResult):
+            return(value)
+        if isinstance(value, BaseException):
+            return(cls('exception', None, repr(value)))
+        if isinstance(value, tuple):
+            status = cls.prefixes.get(value[0] if len(value) > 0 else None, 'error')
+            detail = value[1] if len(value) > 1 else None
+            if status == 'http_error':
+                return(cls(status, detail))
+            return(cls(status, None, None if detail is None else str(detail)))
+        return(cls('ok', None, None, value))
+
+    def toDict(self):
+        return({'status': self.status, 'code': self.code, 'message': self.message,
+            'latency': self.latency, 'attempts': self.attempts, 'endpoint': self.endpoint})
+
+    def __str__(self):
+        # e.g. 'ok 0: ok', 'provider_error 310000: keywords not in content'
+        text = self.status
+        if self.code is not None:
+            text = text + ' ' + str(self.code)
+        if self.message:
+            text = text + ': ' + str(self.message)
+        return(text)
+
+    def __repr__(self):
+        return('SendResult(' + repr(self.status) + ', ' + repr(self.code) + ', ' + repr(self.message) + ')')
+
+def formatResult(resp):
+    # text of the result of a channel, results of multiple endpoints are separated by '; '
+    if isinstance(resp, list):
+        return('; '.join(formatResult(r) for r in resp))
+    return(str(resp))
+
+#
+# Channel base
+#
+class Channel():
+    #
+    # common parts of the channels, a channel builds the request of a message in buildRequest,
+    # which is sent by push or by pushAsync on asyncio event loop
+    #
+    configkey = None    #section of the channel in config.yml
+    requires = ()    #modules imported when the channel is configured
+    ratelimit = None    #no limit
+    endpointkeys = ()
+    verify = True    #certificate of the server is verified
+    delimiter = '\n\n'
+    requiredkeys = ()    #settings which must be given in config.yml
+    bodylimit = None    #max size of title and body in limitunit, longer messages are pushed in parts
+    limitunit = 'chars'    #chars, bytes, json or url, see getTextSize
+    codekeys = ()    #keys of the code in the json response of the provider, the first one found is used
+    messagekeys = ()    #keys of the error message in the json response
+    okcodes = (0,)
+    transientcodes = ()    #codes of errors which may go away when retried, e.g. too many messages
+
+    @classmethod
+    def validate(cls,config,name=None):
+        # raises ConfigError if the settings of the channel can not be used
+        if name is None:
+            name = cls.configkey
+        if not isinstance(config, dict):
+            raise ConfigError(name + ': settings should be a mapping')
+        for key in cls.requiredkeys:
+            if config.get(key) is None or config.get(key) == '':
+                raise ConfigError(name + ': ' + key + ' is required')
+        ratelimit = config.get('ratelimit')
+        if isinstance(ratelimit, dict):
+            for key in ('rate', 'per', 'burst'):
+                value = ratelimit.get(key)
+                if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+                    raise ConfigError(name + ': ratelimit: ' + key + ' should be a positive number')
+            if ratelimit.get('mode', 'wait') not in ('wait', 'queue'):
+                raise ConfigError(name + ': ratelimit: mode should be wait or queue')
+            reserved = ratelimit.get('reserved')
+            if reserved is not None and (isinstance(reserved, bool) or not isinstance(reserved, int) or reserved < 0):
+                raise ConfigError(name + ': ratelimit: reserved should be a number of messages')
+        elif ratelimit not in (None, False, 0):
+            raise ConfigError(name + ': ratelimit should be a mapping or false')
+        circuitbreaker = config.get('circuitbreaker')
+        if isinstance(circuitbreaker, dict):
+            for key in ('threshold', 'cooldown'):
+                value = circuitbreaker.get(key)
+                if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+                    raise ConfigError(name + ': circuitbreaker: ' + key + ' should be a positive number')
+        elif circuitbreaker not in (None, False, 0):
+            raise ConfigError(name + ': circuitbreaker should be a mapping or false')
+        bodylimit = config.get('bodylimit')
+        if bodylimit not in (None, False) and (isinstance(bodylimit, bool) or not isinstance(bodylimit, int) or bodylimit < 100):
+            raise ConfigError(name + ': bodylimit should be a number of at least 100, or false')
+
+    def prepare(self,config):
+        # called once for the settings of the channel before any message, to build what can be reused for every message
+        pass
+
+    def splitConfig(self,config):
+        # settings of each endpoint which the dispatcher pushes as a separate job, e.g. for multiple endpoints
+        return([config])
+
+    def buildRequest(self,config,msg):
+        # returns request.Request or url
+        raise NotImplementedError
+
+    def parseResponse(self,data):
+        # returns SendResult from the response of the provider
+        if len(self.codekeys) == 0:
+            return(SendResult('ok', None, None, data))
+        try:
+            parsed = json.loads(data)
+        except ValueError:
+            parsed = None
+        if not isinstance(parsed, dict):
+            #e.g. an error page of a proxy, which may be gone when retried
+            return(SendResult('provider_error', None, 'invalid response', data, True))
+        code = next((parsed[k] for k in self.codekeys if k in parsed), None)
+        message = next((parsed[k] for k in self.messagekeys if k in parsed), None)
+        if code is None:
+            return(SendResult('provider_error', None, message or 'unexpected response', data, True))
+        if code in self.okcodes:
+            return(SendResult('ok', code, message, data))
+        return(SendResult('provider_error', code, message, data, code in self.transientcodes))
+
+    def parseError(self,e):
+        # returns SendResult of HTTPError, with the error message of the provider if it is given in the body
+        try:
+            data = e.read().decode()
+        except (OSError, ValueError, AttributeError):
+            data = ''
+        message = e.reason
+        if data != '' and len(self.codekeys) > 0:
+            message = self.parseResponse(data).message or message
+        return(SendResult('http_error', e.code, None if message is None else str(message), data))
+
+    def send(self,req):
+        #send data to endpoint
+        try:
+            resp = transport.urlopen(req, verify=self.verify)
+            return(self.parseResponse(resp.read().decode()))
+        except HTTPError as e:
+            return(self.parseError(e))
+        except URLError as e:
+            return(SendResult('network_error', None, str(e.reason)))
+
+    async def sendAsync(self,req):
+        #send data to endpoint
+        try:
+            resp = await getAsyncTransport().urlopen(req, verify=self.verify)
+            return(self.parseResponse(resp.read().decode()))
+        except HTTPError as e:
+            return(self.parseError(e))
+        except URLError as e:
+            return(SendResult('network_error', None, str(e.reason)))
+
+    def getParts(self,config,msg):
+        # parts of the message within the limit of the provider, 'bodylimit' in the settings of the channel
+        # replaces the default of the channel, false for no limit
+        limit = config.get('bodylimit', self.bodylimit)
+        if not limit:
+            return([msg])
+        return(msg.getParts(self.delimiter, limit, self.limitunit))
+
+    def getPartResult(self,resp,index,count):
+        # result of a part which has failed, the parts after it are not pushed
+        if count > 1 and isinstance(resp, SendResult):
+            resp.message = 'part ' + str(index + 1) + '/' + str(count) + (': ' + str(resp.message) if resp.message else '')
+            resp.part = index
+        return(resp)
+
+    def pushPart(self,config,msg):
+        return(self.send(self.buildRequest(config, msg)))
+
+    async def pushPartAsync(self,config,msg):
+        return(await self.sendAsync(self.buildRequest(config, msg)))
+
+    def push(self,config,content):
+        # parts of a long message are pushed one by one in order, on the same connection of the transport,
+        # from the first part not delivered yet
+        msg = Message.fromContent(content)
+        parts = self.getParts(config, msg)
+        for i in range(min(msg.firstpart, len(parts) - 1), len(parts)):
+            resp = self.pushPart(config, parts[i])
+            if isFailure(resp):
+                return(self.getPartResult(resp, i, len(parts)))
+        return(resp)
+
+    async def pushAsync(self,config,content):
+        msg = Message.fromContent(content)
+        parts = self.getParts(config, msg)
+        for i in range(min(msg.firstpart, len(parts) - 1), len(parts)):
+            resp = await self.pushPartAsync(config, parts[i])
+            if isFailure(resp):
+                return(self.getPartResult(resp, i, len(parts)))
+        return(resp)
+
 #
 # Bark service
 #
-class Bark():
+class Bark(Channel):
     #
     # Bark instructions: https://github.com/Finb/Bark
     #
+    configkey = 'bark'
+    ratelimit = None    #no limit
+    endpointkeys = ('endpoint',)
+    requiredkeys = ('endpoint',)
+    bodylimit = 3800    #apns payload is at most 4096 bytes
+    limitunit = 'bytes'
+    codekeys = ('code',)
+    messagekeys = ('message',)
+    okcodes = (200,)
+
+    maxworkers = 16    #max number of endpoints pushed at the same time by push
+
     def __init__(self):
         self.delimiter = '\n'
+        self.tailoringindexes = {}
+        self.splitconfigs = {}
 
-    def push(self,config,content):
+    @classmethod
+    def validate(cls,config,name=None):
+        super().validate(config, name)
+        if name is None:
+            name = cls.configkey
+        endpoint = config.get('endpoint')
+        if isinstance(endpoint, list):
+            if len(endpoint) == 0 or not all(isinstance(e, str) and e != '' for e in endpoint):
+                raise ConfigError(name + ': endpoint should be a url or a list of urls')
+        elif not isinstance(endpoint, str):
+            raise ConfigError(name + ': endpoint should be a url or a list of urls')
+        levels = config.get('levels')
+        if levels is not None:
+            if not isinstance(levels, dict):
+                raise ConfigError(name + ': levels should be a mapping of priorities')
+            for priority in levels:
+                if priority not in priorities:
+                    raise ConfigError(name + ': levels: ' + str(priority) + ' is not one of ' + ', '.join(priorities))
+        tailoring = config.get('tailoring')
+        if tailoring is None:
+            return
+        if not isinstance(tailoring, list):
+            raise ConfigError(name + ': tailoring should be a list')
+        for i,t in enumerate(tailoring):
+            if not isinstance(t, dict):
+                raise ConfigError(name + ': tailoring ' + str(i + 1) + ' should be a mapping')
+            validateTitle(t.get('title'), name + ': tailoring ' + str(i + 1))
+
+    def prepare(self,config):
+        tailoring = config.get('tailoring')
+        if tailoring is not None:
+            self.getTailoringIndex(tailoring)
+        self.splitConfig(config)
+
+    def splitConfig(self,config):
+        # one config for each endpoint, or for each bark server with batch, which are pushed by the dispatcher at the same time
+        endpoint = config.get('endpoint')
+        if not isinstance(endpoint, list):
+            return([config])
+        entry = self.splitconfigs.get(id(config))
+        if entry is None or entry[0] is not config:
+            if config.get('batch'):
+                servers = {}
+                for e in endpoint:
+                    servers.setdefault(self.getServer(e)[0], []).append(e)
+                parts = [dict(config, endpoint=endpoints) for endpoints in servers.values()]
+            else:
+                parts = [dict(config, endpoint=e) for e in endpoint]
+            entry = (config, parts)
+            self.splitconfigs[id(config)] = entry
+        return(entry[1])
+
+    def getServer(self,endpoint):
+        # returns (server, devicekey) of an endpoint like https://<your-url>/<your-key>/
+        server, _, devicekey = endpoint.rstrip('/').rpartition('/')
+        return((server, devicekey))
+
+    def buildBatchRequests(self,endpoints,title,body,parameters):
+        # one request for all the devices of each server, with the device_keys of bark server v2
+        # returns the request, or a list of requests for multiple servers
+        servers = {}
+        for e in endpoints:
+            server, devicekey = self.getServer(e)
+            servers.setdefault(server, []).append(devicekey)
+        header = {
+            "Content-Type": "application/json; charset=utf-8"
+        }
+        reqs = []
+        for server,devicekeys in servers.items():
+            message = dict(parameters)
+            message['title'] = title
+            message['body'] = body
+            message['device_keys'] = devicekeys
+            postdata = json.dumps(message, ensure_ascii=False).encode("utf-8")
+            reqs.append(request.Request(url=server + '/push', data=postdata, headers=header))
+        if len(reqs) == 1:
+            return(reqs[0])
+        return(reqs)
+
+    def getTailoringIndex(self,tailoring):
+        # compiled once for each tailoring list, e.g. of the channel and of routing overrides
+        entry = self.tailoringindexes.get(id(tailoring))
+        if entry is None or entry[0] is not tailoring:
+            entry = (tailoring, TailoringIndex(tailoring))
+            self.tailoringindexes[id(tailoring)] = entry
+        return(entry[1])
+
+    def buildRequest(self,config,msg):
+        # returns one request, or a list of requests for multiple endpoints, or for multiple servers with batch
         #handle message
-        if(len(content)<2):
-            title = "参数个数不对!"
-            body = "null"
-        else:
-            title = content[0]
-            body = ""
-            for i in range(1,len(content)):
-                v = content[i]
-                v = MessageFormatter().convertBytes(v)
-                v = MessageFormatter().getHostLocation(v)
-                body = body + v + self.delimiter
-            if (len(body)>5000):  #bark has limitation of 5000 characters in body
-                body = body[0:5000]
+        title = msg.title
+        body = msg.getBody(self.delimiter)
 
         #load config
         endpoint = config.get('endpoint')
@@ -145,52 +1564,37 @@ class Bark():
         isArchive = config.get('isArchive')
         url = config.get('url')
         level = config.get('level')
+        levels = config.get('levels')
+        if levels is not None and levels.get(msg.priority) is not None:
+            level = levels[msg.priority]
 
         #get tailor made config
         tailoring = config.get('tailoring')
         if tailoring is not None:
-            for t in config.get('tailoring'):
-                t_title = t.get('title')
-                matchtitle = False
-                if isinstance(t_title, str):
-                    if title == t.get('title'):
-                        matchtitle = True
-                if isinstance(t_title, list):
-                    for e in t_title:
-                        if isinstance(e, str):
-                            if title == e:
-                                matchtitle = True
-                        if isinstance(e, list):
-                            #list inside a list for regexp
-                            for r in e:
-                                ptn = re.compile(r)
-                                matchtitle = bool(ptn.search(title))
-                                if matchtitle:
-                                    break
-
-                if matchtitle:
-                    t_group = t.get('group')
-                    t_icon = t.get('icon')
-                    t_sound = t.get('sound')
-                    t_automaticallyCopy = t.get('automaticallyCopy')
-                    t_isArchive = t.get('isArchive')
-                    t_url = t.get('url')
-                    t_level = t.get('level')
-                    if t_group is not None:
-                        group = t_group
-                    if t_icon is not None:
-                        icon = t_icon
-                    if t_sound is not None:
-                        sound = t_sound
-                    if t_automaticallyCopy is not None:
-                        automaticallyCopy = t_automaticallyCopy
-                    if t_isArchive is not None:
-                        isArchive = t_isArchive
-                    if t_url is not None:
-                        url = t_url
-                    if t_group is not None:
-                        level = t_level
-                    break
+            #parts of a long message have the same tailoring as the message
+            t = self.getTailoringIndex(tailoring).match(msg.basetitle)
+            if t is not None:
+                t_group = t.get('group')
+                t_icon = t.get('icon')
+                t_sound = t.get('sound')
+                t_automaticallyCopy = t.get('automaticallyCopy')
+                t_isArchive = t.get('isArchive')
+                t_url = t.get('url')
+                t_level = t.get('level')
+                if t_group is not None:
+                    group = t_group
+                if t_icon is not None:
+                    icon = t_icon
+                if t_sound is not None:
+                    sound = t_sound
+                if t_automaticallyCopy is not None:
+                    automaticallyCopy = t_automaticallyCopy
+                if t_isArchive is not None:
+                    isArchive = t_isArchive
+                if t_url is not None:
+                    url = t_url
+                if t_level is not None:
+                    level = t_level
 
         parameters = {}
         if group is not None:
@@ -205,283 +1609,388 @@ class Bark():
             parameters['isArchive'] = isArchive
         if url is not None:
             parameters['url'] = url
-        if group is not None:
+        if level is not None:
             parameters['level'] = level
 
-        #initialize endpoint
+        if isinstance(endpoint, list) and config.get('batch'):
+            return(self.buildBatchRequests(endpoint, title, body, parameters))
+
+        #format posting data, built once for all the endpoints
+        header = {
+            "Content-Type": "application/json; charset=utf-8"
+        }
+        message = dict(parameters)
+        message['title'] = title
+        message['body'] = body
+        postdata = json.dumps(message, ensure_ascii=False).encode("utf-8")
+
+        #initialize endpoint, the message is posted to the url of the device
         if isinstance(endpoint, list):
-            endpoints = []
-            for e in endpoint:
-                if not e.endswith("/"):
-                    e = e + "/"
-                parameter = ''
-                conchar = '?'
-                for k,v in parameters.items():
-                    parameter = parameter + conchar + k + '=' + parse.quote_plus(str(v))
-                    conchar = '&'
-
-                e = e + parse.quote_plus(title) + '/'
-                e = e + parse.quote_plus(body) 
-                e = e + parameter
-                endpoints.append(e)
-        else:
-            if not endpoint.endswith("/"):
-                endpoint = endpoint + "/"
-            parameter = ''
-            conchar = '?'
-            for k,v in parameters.items():
-                parameter = parameter + conchar + k + '=' + parse.quote_plus(str(v))
-                conchar = '&'
-    
-            endpoint = endpoint + parse.quote_plus(title) + '/'
-            endpoint = endpoint + parse.quote_plus(body) 
-            endpoint = endpoint + parameter
+            return([request.Request(url=e.rstrip('/'), data=postdata, headers=header) for e in endpoint])
+        return(request.Request(url=endpoint.rstrip('/'), data=postdata, headers=header))
 
-        #send data to bark server
+    def sendSafely(self,req):
+        # a broken endpoint gives its own result rather than stopping the others
         try:
-            if isinstance(endpoint, list):
-                resps = []
-                for e in endpoints:
-                    resp = request.urlopen(e)
-                    resps.append(resp.read().decode())
-                return(resps)
-            else:
-                resp = request.urlopen(endpoint) 
-                return(resp.read().decode())
-        except HTTPError as e:
-            # do something
-            return('Error code: ', e.code)
-        except URLError as e:
-            # do something
-            return('Reason: ', e.reason)
-        else:
-            # do something
-            return('Unknown exception!')
+            return(self.send(req))
+        except Exception as e:
+            return(SendResult('exception', None, repr(e)))
+
+    def pushPart(self,config,msg):
+        req = self.buildRequest(config, msg)
+        #send data to bark server
+        if isinstance(req, list):
+            #one result for each endpoint, they are pushed at the same time with the connections of each host shared
+            if len(req) == 1:
+                return([self.sendSafely(req[0])])
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.maxworkers, len(req))) as executor:
+                #phases of the endpoints are counted in the push of the dispatcher
+                futures = [executor.submit(contextvars.copy_context().run, self.sendSafely, r) for r in req]
+                return([future.result() for future in futures])
+        return(self.send(req))
+
+    async def pushPartAsync(self,config,msg):
+        req = self.buildRequest(config, msg)
+        #send data to bark server
+        if isinstance(req, list):
+            resps = await asyncio.gather(*[self.sendAsync(e) for e in req], return_exceptions=True)
+            return([SendResult('exception', None, repr(resp)) if isinstance(resp, Exception) else resp for resp in resps])
+        return(await self.sendAsync(req))
 
 #
 # ServerChan Service
 #
-class ServerChan():
+class ServerChan(Channel):
     #
     # ServerChan instructions: https://sct.ftqq.com/
     #
+    configkey = 'serverchan'
+    ratelimit = (5, 60)    #5 messages per minute
+    endpointkeys = ('sckey',)
+    requiredkeys = ('sckey',)
+    bodylimit = 32000    #desp is at most 32k bytes
+    limitunit = 'bytes'
+    codekeys = ('code', 'errno')    #code of sctapi, errno of the old api
+    messagekeys = ('message', 'errmsg')
+    verify = False    #certificate of the server is not verified
+
     def __init__(self):
         self.delimiter = '\n\n'
         self.oldscurl = 'https://sc.ftqq.com/'
         self.newscurl = 'https://sctapi.ftqq.com/'
 
-    def push(self,config,content):
-        #handle message    
-        if(len(content)<2):
-            title = "参数个数不对!"
-            body = "null"
-        else:
-            title = content[0]
-            body = ""
-            for i in range(1,len(content)):
-                v = content[i]
-                v = MessageFormatter().convertBytes(v)
-                v = MessageFormatter().getHostLocation(v)
-                body = body + v + self.delimiter
+    def buildRequest(self,config,msg):
+        #handle message
+        title = msg.title
+        body = msg.getBody(self.delimiter)
 
         #load config
         sckey = config.get('sckey')
 
-        #initialize endpoint
+        #initialize endpoint and format posting data
         if sckey.startswith("SCU"):
+            #the old api takes form data
             endpoint = self.oldscurl + sckey + ".send"
+            header = {
+                "Content-Type": "application/x-www-form-urlencoded"
+            }
+            postdata = parse.urlencode({"text": title, "desp": body}).encode("utf-8")
         else:
             endpoint = self.newscurl + sckey + ".send"
+            header = {
+                "Content-Type": "application/json;charset=utf-8"
+            }
+            postdata = json.dumps({"title": title, "desp": body}, ensure_ascii=False).encode("utf-8")
 
-
-        #format posting data
-        endpoint = endpoint + "?text=" + parse.quote(title) + "&desp=" + parse.quote(body)
-
-        #send data to endpoint
-        try:
-            #print(endpoint)
-            ssl._create_default_https_context = ssl._create_unverified_context
-            resp = request.urlopen(endpoint)
-            return(resp.read().decode())
-        except HTTPError as e:
-            # do something
-            return('Error code: ', e.code)
-        except URLError as e:
-            # do something
-            return('Reason: ', e.reason)
-        else:
-            # do something
-            return('Unknown exception!')
+        return(request.Request(url=endpoint, data=postdata, headers=header))
 
 #
 # PushPlus Service
 #
-class PushPlus():
+class PushPlus(Channel):
     #
     # PushPlus instructions: https://www.pushplus.plus/
     #
+    configkey = 'pushplus'
+    ratelimit = None    #no limit
+    endpointkeys = ('token',)
+    requiredkeys = ('token',)
+    codekeys = ('code',)
+    messagekeys = ('msg',)
+    okcodes = (200,)
+    transientcodes = (999,)    #service busy
+    verify = False    #certificate of the server is not verified
+
     def __init__(self):
         self.delimiter = '\n\n'
         self.endpoint = 'http://www.pushplus.plus/'
 
-    def push(self,config,content):
-        #handle message    
-        if(len(content)<2):
-            title = "参数个数不对!"
-            body = "null"
-        else:
-            title = content[0]
-            body = ""
-            for i in range(1,len(content)):
-                v = content[i]
-                v = MessageFormatter().convertBytes(v)
-                v = MessageFormatter().getHostLocation(v)
-                body = body + v + self.delimiter
+    def buildRequest(self,config,msg):
+        #handle message
+        title = msg.title
+        body = msg.getBody(self.delimiter)
 
         #load config
         token = config.get('token')
         channel = config.get('channel')
         template = config.get('template')
 
-        #initialize endpoint
-        endpoint = self.endpoint + 'send?token=' + token
+        #initialize endpoint and header
+        endpoint = self.endpoint + 'send'
+        header = {
+            "Content-Type": "application/json;charset=utf-8"
+        }
+
+        #format posting data
+        message = {
+            "token": token,
+            "title": title,
+            "content": body
+        }
         if channel is not None:
-            endpoint = endpoint + '&channel=' + channel
+            message['channel'] = channel
         if template is not None:
-            endpoint = endpoint + '&template=' + template
+            message['template'] = template
+        postdata = json.dumps(message, ensure_ascii=False).encode("utf-8")
 
-        #format posting data
-        endpoint = endpoint + "&title=" + parse.quote(title) + "&content=" + parse.quote(body)
-
-        #send data to endpoint
-        try:
-            #print(endpoint)
-            ssl._create_default_https_context = ssl._create_unverified_context
-            resp = request.urlopen(endpoint)
-            return(resp.read().decode())
-        except HTTPError as e:
-            # do something
-            return('Error code: ', e.code)
-        except URLError as e:
-            # do something
-            return('Reason: ', e.reason)
-        else:
-            # do something
-            return('Unknown exception!')
+        return(request.Request(url=endpoint, data=postdata, headers=header))
 
 #
 # Iyuu Service
 #
-class Iyuu():
+class Iyuu(Channel):
     #
     # Iyuu instructions: https://iyuu.cn/
     #
+    configkey = 'iyuu'
+    ratelimit = None    #no limit
+    endpointkeys = ('token',)
+    requiredkeys = ('token',)
+    codekeys = ('errcode',)
+    messagekeys = ('errmsg',)
+    verify = False    #certificate of the server is not verified
+
     def __init__(self):
         self.delimiter = '\n\n'
         self.endpoint = 'https://iyuu.cn/'
 
-    def push(self,config,content):
-        #handle message    
-        if(len(content)<2):
-            title = "参数个数不对!"
-            body = "null"
-        else:
-            title = content[0]
-            body = ""
-            for i in range(1,len(content)):
-                v = content[i]
-                v = MessageFormatter().convertBytes(v)
-                v = MessageFormatter().getHostLocation(v)
-                body = body + v + self.delimiter
+    def buildRequest(self,config,msg):
+        #handle message
+        title = msg.title
+        body = msg.getBody(self.delimiter)
 
         #load config
         token = config.get('token')
 
-        #initialize endpoint
+        #initialize endpoint and header
         endpoint = self.endpoint + token + ".send"
+        header = {
+            "Content-Type": "application/x-www-form-urlencoded"
+        }
 
         #format posting data
-        endpoint = endpoint + "?text=" + parse.quote(title) + "&desp=" + parse.quote(body)
+        postdata = parse.urlencode({"text": title, "desp": body}).encode("utf-8")
 
-        #send data to endpoint
+        return(request.Request(url=endpoint, data=postdata, headers=header))
+
+#
+# SMTP sessions
+#
+class SMTPSessionManager():
+    #
+    # keep authenticated smtp sessions alive and reuse them for the next messages
+    #
+    def __init__(self,idletimeout=60,checkafter=5):
+        self.idletimeout = idletimeout
+        self.checkafter = checkafter    #sessions idle for less are reused without a NOOP
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def getKey(self,server,port,sender,authcode):
+        return((server, port, sender, hashlib.sha256(str(authcode).encode('utf-8')).hexdigest()))
+
+    def connect(self,server,port,sender,authcode):
+        connecttimeout, readtimeout = transport.getTimeouts()
+        with metrics.phase('connect'):
+            smtpcon = smtplib.SMTP_SSL(server, port, timeout=connecttimeout)
+            smtpcon.sock.settimeout(readtimeout)
+            smtpcon.login(sender, authcode)
+        return(smtpcon)
+
+    def isAlive(self,smtpcon):
         try:
-            #print(endpoint)
-            ssl._create_default_https_context = ssl._create_unverified_context
-            resp = request.urlopen(endpoint)
-            return(resp.read().decode())
-        except HTTPError as e:
-            # do something
-            return('Error code: ', e.code)
-        except URLError as e:
-            # do something
-            return('Reason: ', e.reason)
-        else:
-            # do something
-            return('Unknown exception!')
+            return(smtpcon.noop()[0] == 250)
+        except (smtplib.SMTPException, OSError):
+            return(False)
+
+    def close(self,smtpcon):
+        try:
+            smtpcon.quit()
+        except (smtplib.SMTPException, OSError):
+            smtpcon.close()
+
+    def closeAll(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = {}
+        for session in sessions:
+            with session['lock']:
+                if session['con'] is not None:
+                    self.close(session['con'])
+                    session['con'] = None
+
+    def sendOne(self,session,server,port,sender,authcode,recipients,msgstring):
+        if session['con'] is None:
+            session['con'] = self.connect(server, port, sender, authcode)
+        try:
+            with metrics.phase('request'):
+                return(session['con'].sendmail(sender, recipients, msgstring))
+        except smtplib.SMTPServerDisconnected:
+            #session dropped by the server, log in again and send this mail once more
+            session['con'].close()
+            session['con'] = None
+            session['con'] = self.connect(server, port, sender, authcode)
+            with metrics.phase('request'):
+                return(session['con'].sendmail(sender, recipients, msgstring))
+
+    def sendBatch(self,server,port,sender,authcode,mails):
+        # mails is a list of (recipients, msgstring), all sent on one session
+        # returns the dict of refused recipients (see smtplib.SMTP.sendmail) or the exception for each mail
+        key = self.getKey(server, port, sender, authcode)
+        with self.lock:
+            session = self.sessions.setdefault(key, {'con': None, 'lastused': 0, 'lock': threading.Lock()})
+        with session['lock']:
+            if session['con'] is not None:
+                #a session dropped anyway is logged in again by sendOne
+                idle = time.monotonic() - session['lastused']
+                if idle > self.idletimeout or (idle > self.checkafter and not self.isAlive(session['con'])):
+                    self.close(session['con'])
+                    session['con'] = None
+            results = []
+            for recipients,msgstring in mails:
+                try:
+                    results.append(self.sendOne(session, server, port, sender, authcode, recipients, msgstring))
+                except (smtplib.SMTPException, OSError) as e:
+                    if session['con'] is not None and not isinstance(e, (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused)):
+                        #the session is broken, the next mail will log in again
+                        self.close(session['con'])
+                        session['con'] = None
+                    results.append(e)
+            session['lastused'] = time.monotonic()
+            return(results)
+
+smtpsessions = SMTPSessionManager()
+atexit.register(smtpsessions.closeAll)
 
 #
 # SMTP Service
 #
-class SMTP():
+class SMTP(Channel):
     #
     # SMTP instructions: https://docs.python.org/3/library/smtplib.html
     #
+    configkey = 'smtp'
+    requires = ('smtplib', 'email.mime.multipart', 'email.mime.text', 'email.header')
+    ratelimit = None    #no limit
+    endpointkeys = ('server', 'sender')
+    requiredkeys = ('server', 'port', 'sender', 'authcode', 'recipient')
+
     def __init__(self):
         self.delimiter = '\n\n'
 
+    def getRecipients(self,recipient):
+        # recipient can be a list or a string separated by ',' or ';'
+        if isinstance(recipient, list):
+            return([str(r).strip() for r in recipient if str(r).strip() != ''])
+        return([r.strip() for r in re.split(r'[,;]', recipient) if r.strip() != ''])
+
+    def formatMail(self,config,content):
+        # returns (recipients, msgstring)
+        #handle message
+        msg = Message.fromContent(content)
+        title = msg.title
+        body = msg.getBody(self.delimiter)
+
+        #load config
+        sender = config.get('sender')
+        recipients = self.getRecipients(config.get('recipient'))
+
+        #format posting data
+        mailsubject = emailheader.Header(title, 'utf-8').encode()
+        mailbody = mimetext.MIMEText(body, 'plain', 'utf-8')
+        smtpmsg = mimemultipart.MIMEMultipart()
+        smtpmsg['Subject'] = mailsubject
+        smtpmsg['From'] = sender
+        smtpmsg['To'] = ', '.join(recipients)
+        smtpmsg.attach(mailbody)
+        return((recipients, smtpmsg.as_string()))
+
     def push(self,config,content):
-        #handle message    
-        if(len(content)<2):
-            title = "参数个数不对!"
-            body = "null"
-        else:
-            title = content[0]
-            body = ""
-            for i in range(1,len(content)):
-                v = content[i]
-                v = MessageFormatter().convertBytes(v)
-                v = MessageFormatter().getHostLocation(v)
-                body = body + v + self.delimiter
+        return(self.pushBatch(config, [content])[0])
+
+    async def pushAsync(self,config,content):
+        #smtplib is blocking, the pooled smtp sessions are used in the default executor of the loop
+        return(await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run, self.push, config, content))
 
+    def pushBatch(self,config,contents):
+        # send several messages on one smtp session, returns one result for each message
         #load config
         server = config.get('server')
         port = config.get('port')
         sender = config.get('sender')
         authcode = config.get('authcode')
-        recipient = config.get('recipient')
 
-        #format posting data
-        mailsubject = Header(title, 'utf-8').encode()
-        mailbody = MIMEText(body, 'plain', 'utf-8')
+        mails = [self.formatMail(config, content) for content in contents]
 
         #send email via smtp server
-        try:
-            smtpcon = smtplib.SMTP_SSL(server, port)
-            smtpcon.login(sender, authcode)
-            smtpmsg = MIMEMultipart()
-            smtpmsg['Subject'] = mailsubject
-            smtpmsg['From'] = sender
-            smtpmsg['To'] = recipient
-            smtpmsg.attach(mailbody)
-            smtpcon.sendmail(sender, recipient, smtpmsg.as_string())
-            smtpcon.quit()
-            return("successful!")
-        except smtplib.SMTPException as e:
-            #do something
-            return('Error code: ', e.errno)
-        else:
-            # do something
-            return('Unknown exception!')            
+        results = []
+        for refused in smtpsessions.sendBatch(server, port, sender, authcode, mails):
+            if isinstance(refused, smtplib.SMTPRecipientsRefused):
+                results.append(SendResult('refused', None, ', '.join(refused.recipients.keys())))
+            elif isinstance(refused, smtplib.SMTPException):
+                code = getattr(refused, 'smtp_code', None)
+                #4xx replies of smtp servers are temporary failures
+                results.append(SendResult('provider_error', code, str(refused), None, isinstance(code, int) and 400 <= code < 500))
+            elif isinstance(refused, OSError):
+                results.append(SendResult('network_error', None, str(refused)))
+            elif len(refused) > 0:
+                results.append(SendResult('refused', None, ', '.join(refused.keys())))
+            else:
+                results.append(SendResult('ok', 250, 'successful!'))
+        return(results)
 
 #
 # DingTalk service
 #
-class DingTalk():
+class DingTalk(Channel):
     #
     # DingTalk instructions: https://open.dingtalk.com/document/robots/custom-robot-access
     #
+    configkey = 'dingtalk'
+    requires = ('hmac',)
+    ratelimit = (20, 60)    #20 messages per minute for each robot
+    endpointkeys = ('url',)
+    requiredkeys = ('url', 'secret')
+    bodylimit = 20000    #content is at most 20000 bytes
+    limitunit = 'bytes'
+    codekeys = ('errcode',)
+    messagekeys = ('errmsg',)
+    transientcodes = (-1, 130101)    #system busy, too many messages
+
     def __init__(self):
         self.delimiter = '\n\n'
+        self.signers = {}
+
+    def prepare(self,config):
+        self.getSigner(config.get('secret'))
+
+    def getSigner(self,secret):
+        # hmac with the secret as key is set up once, and copied for every message
+        signer = self.signers.get(secret)
+        if signer is None:
+            signer = hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
+            self.signers[secret] = signer
+        return(signer)
 
     def formatMessage(self,title, body):
         json_text = {
@@ -496,33 +2005,24 @@ class DingTalk():
         }
         return json_text
 
-    def push(self,config,content):
-        #handle message    
-        if(len(content)<2):
-            title = "参数个数不对!"
-            body = "null"
-        else:
-            title = content[0]
-            body = ""
-            for i in range(1,len(content)):
-                v = content[i]
-                v = MessageFormatter().convertBytes(v)
-                v = MessageFormatter().getHostLocation(v)
-                body = body + v + self.delimiter
-            if (len(body)>5000):  #bark has limitation of 5000 characters in body
-                body = body[0:5000]
+    def buildRequest(self,config,msg):
+        #handle message
+        title = msg.title
+        body = msg.getBody(self.delimiter)
 
         #load config
         secret = config.get('secret')
         endpoint = config.get('url')
 
         #initialize endpoint and sign
-        timestamp = str(round(time.time() * 1000))
-        secret_enc = secret.encode("utf-8")
-        string_to_sign = "{}\n{}".format(timestamp, secret)
-        string_to_sign_enc = string_to_sign.encode("utf-8")
-        hmac_code = hmac.new(secret_enc, string_to_sign_enc, digestmod=hashlib.sha256).digest()
-        sign = parse.quote_plus(base64.b64encode(hmac_code))
+        with metrics.phase('signing'):
+            timestamp = str(round(time.time() * 1000))
+            string_to_sign = "{}\n{}".format(timestamp, secret)
+            string_to_sign_enc = string_to_sign.encode("utf-8")
+            signer = self.getSigner(secret).copy()
+            signer.update(string_to_sign_enc)
+            hmac_code = signer.digest()
+            sign = parse.quote_plus(base64.b64encode(hmac_code))
         endpoint = endpoint + "&timestamp={}&sign={}".format(timestamp, sign)
         header = {
             "Content-Type": "application/json",
@@ -532,30 +2032,28 @@ class DingTalk():
         #format posting data
         message = self.formatMessage(title, body)
 
-        #send data to dingtalk
-        try:
-            postdata = json.dumps(message)
-            postdata = postdata.encode("utf-8")
-            handler = request.Request(url=endpoint, data=postdata, headers=header) 
-            resp = request.urlopen(handler) 
-            return(resp.read().decode())
-        except HTTPError as e:
-            # do something
-            return('Error code: ', e.code)
-        except URLError as e:
-            # do something
-            return('Reason: ', e.reason)
-        else:
-            # do something
-            return('Unknown exception!')
+        postdata = json.dumps(message)
+        postdata = postdata.encode("utf-8")
+        return(request.Request(url=endpoint, data=postdata, headers=header))
 
 #
 # FeiShu service
 #
-class FeiShu():
+class FeiShu(Channel):
     #
     # FeiShu instructions: https://www.feishu.cn/hc/zh-CN/articles/360024984973
     #
+    configkey = 'feishu'
+    requires = ('hmac',)
+    ratelimit = (100, 60)    #100 messages per minute for each robot
+    endpointkeys = ('url',)
+    requiredkeys = ('url', 'secret')
+    bodylimit = 19000    #request is at most 20k bytes, non-ascii chars are escaped in json
+    limitunit = 'json'
+    codekeys = ('code', 'StatusCode')    #StatusCode of old robots
+    messagekeys = ('msg', 'StatusMessage')
+    transientcodes = (9499, 11232)    #too many requests, frequency limited
+
     def __init__(self):
         self.delimiter = '\n\n'
 
@@ -570,33 +2068,23 @@ class FeiShu():
         } 
         return json_text
 
-    def push(self,config,content):
-        #handle message    
-        if(len(content)<2):
-            title = "参数个数不对!"
-            body = "null"
-        else:
-            title = content[0]
-            body = ""
-            for i in range(1,len(content)):
-                v = content[i]
-                v = MessageFormatter().convertBytes(v)
-                v = MessageFormatter().getHostLocation(v)
-                body = body + v + self.delimiter
-            if (len(body)>5000):  #bark has limitation of 5000 characters in body
-                body = body[0:5000]
+    def buildRequest(self,config,msg):
+        #handle message
+        title = msg.title
+        body = msg.getBody(self.delimiter)
 
         #load config
         secret = config.get('secret')
         endpoint = config.get('url')
 
         #initialize endpoint and sign
-        timestamp = str(round(time.time()))
-        secret_enc = secret.encode("utf-8")
-        string_to_sign = "{}\n{}".format(timestamp, secret)
-        string_to_sign_enc = string_to_sign.encode("utf-8")
-        hmac_code = hmac.new(string_to_sign_enc, digestmod=hashlib.sha256).digest()
-        sign = base64.b64encode(hmac_code).decode('utf-8')
+        with metrics.phase('signing'):
+            timestamp = str(round(time.time()))
+            secret_enc = secret.encode("utf-8")
+            string_to_sign = "{}\n{}".format(timestamp, secret)
+            string_to_sign_enc = string_to_sign.encode("utf-8")
+            hmac_code = hmac.new(string_to_sign_enc, digestmod=hashlib.sha256).digest()
+            sign = base64.b64encode(hmac_code).decode('utf-8')
         header = {
             "Content-Type": "application/json",
             "Charset": "UTF-8"
@@ -605,30 +2093,27 @@ class FeiShu():
         #format posting data
         message = self.formatMessage(title, body, timestamp, sign)
 
-        #send data to feishu
-        try:
-            postdata = json.dumps(message)
-            postdata = postdata.encode("utf-8")
-            handler = request.Request(url=endpoint, data=postdata, headers=header) 
-            resp = request.urlopen(handler) 
-            return(resp.read().decode())
-        except HTTPError as e:
-            # do something
-            return('Error code: ', e.code)
-        except URLError as e:
-            # do something
-            return('Reason: ', e.reason)
-        else:
-            # do something
-            return('Unknown exception!')
+        postdata = json.dumps(message)
+        postdata = postdata.encode("utf-8")
+        return(request.Request(url=endpoint, data=postdata, headers=header))
 
 #
 # WxBot service
 #
-class WxBot():
+class WxBot(Channel):
     #
     # WxBot instructions: https://developer.work.weixin.qq.com/document/path/91770
     #
+    configkey = 'wxbot'
+    ratelimit = (20, 60)    #20 messages per minute for each robot
+    endpointkeys = ('url',)
+    requiredkeys = ('url',)
+    bodylimit = 4096    #markdown content is at most 4096 bytes
+    limitunit = 'bytes'
+    codekeys = ('errcode',)
+    messagekeys = ('errmsg',)
+    transientcodes = (-1, 45009)    #system busy, too many messages
+
     def __init__(self):
         self.delimiter = '\n\n'
 
@@ -644,21 +2129,10 @@ class WxBot():
         }
         return json_text
 
-    def push(self,config,content):
-        #handle message    
-        if(len(content)<2):
-            title = "参数个数不对!"
-            body = "null"
-        else:
-            title = content[0]
-            body = ""
-            for i in range(1,len(content)):
-                v = content[i]
-                v = MessageFormatter().convertBytes(v)
-                v = MessageFormatter().getHostLocation(v)
-                body = body + v + self.delimiter
-            if (len(body)>5000):  #bark has limitation of 5000 characters in body
-                body = body[0:5000]
+    def buildRequest(self,config,msg):
+        #handle message
+        title = msg.title
+        body = msg.getBody(self.delimiter)
 
         #load config
         endpoint = config.get('url')
@@ -671,35 +2145,39 @@ class WxBot():
         #format posting data
         message = self.formatMessage(title, body)
 
-        #send data to wxbot
-        try:
-            postdata = json.dumps(message)
-            postdata = postdata.encode("utf-8")
-            handler = request.Request(url=endpoint, data=postdata, headers=header) 
-            resp = request.urlopen(handler) 
-            return(resp.read().decode())
-        except HTTPError as e:
-            # do something
-            return('Error code: ', e.code)
-        except URLError as e:
-            # do something
-            return('Reason: ', e.reason)
-        else:
-            # do something
-            return('Unknown exception!')
+        postdata = json.dumps(message)
+        postdata = postdata.encode("utf-8")
+        return(request.Request(url=endpoint, data=postdata, headers=header))
 
 #
 # WxApp service
 #
-class WxApp():
+class TokenError(Exception):
+    # the provider gives no access token, result is the SendResult of its answer, e.g. wrong secret
+    def __init__(self,result):
+        super().__init__(str(result))
+        self.result = result
+
+class WxApp(Channel):
     #
     # WxApp instructions: https://developer.work.weixin.qq.com/document/path/90236
     #
+    configkey = 'wxapp'
+    ratelimit = None    #no limit
+    endpointkeys = ('corpid', 'agentid')
+    requiredkeys = ('corpid', 'secret', 'agentid', 'touser')
+    bodylimit = 2048    #text and markdown content are at most 2048 bytes
+    limitunit = 'bytes'
+    codekeys = ('errcode',)
+    messagekeys = ('errmsg',)
+    transientcodes = (-1, 45009)    #system busy, too many messages
+
     def __init__(self):
         self.delimiter = '\n\n'
         self.endpoint = 'https://qyapi.weixin.qq.com/cgi-bin/message/send?access_token='
+        self.tokenerrors = (40001, 40014, 42001)    #invalid credential, invalid access_token, access_token expired
 
-    def formatMessage(self, touser, agentid, title, body, messagetype):
+    def formatMessage(self, touser, agentid, title, body, messagetype, duplicatecheck=0, duplicateinterval=1800):
         json_md = {
             "touser": touser,
             "msgtype": "markdown",
@@ -707,8 +2185,8 @@ class WxApp():
             "markdown": {
                 "content": "#### **" + title + "** \n\n" + body
             },
-            "enable_duplicate_check": 0,
-            "duplicate_check_interval": 1800
+            "enable_duplicate_check": duplicatecheck,
+            "duplicate_check_interval": duplicateinterval
         }
         json_text = {
            "touser" : touser,
@@ -719,172 +2197,1914 @@ class WxApp():
            },
            "safe":0,
            "enable_id_trans": 0,
-           "enable_duplicate_check": 0,
-           "duplicate_check_interval": 1800
+           "enable_duplicate_check": duplicatecheck,
+           "duplicate_check_interval": duplicateinterval
         }
         if messagetype == "markdown":
             return json_md
         else:
             return json_text
 
-    def getToken(self, corpid, secret):
-        resp = request.urlopen("https://qyapi.weixin.qq.com/cgi-bin/gettoken?corpid=" + corpid + "&corpsecret=" + secret)
-        json_resp = json.loads(resp.read().decode())
-        token = json_resp["access_token"]
-        return token
+    def requestToken(self, corpid, secret):
+        # returns (token, expires_in)
+        resp = transport.urlopen("https://qyapi.weixin.qq.com/cgi-bin/gettoken?corpid=" + parse.quote(corpid) + "&corpsecret=" + parse.quote(secret))
+        return(self.parseToken(resp.read().decode()))
 
-    def push(self,config,content):
-        #handle message    
-        if(len(content)<2):
-            title = "参数个数不对!"
-            body = "null"
-        else:
-            title = content[0]
-            body = ""
-            for i in range(1,len(content)):
-                v = content[i]
-                v = MessageFormatter().convertBytes(v)
-                v = MessageFormatter().getHostLocation(v)
-                body = body + v + self.delimiter
-            if (len(body)>5000):  #bark has limitation of 5000 characters in body
-                body = body[0:5000]
+    def parseToken(self, data):
+        # returns (token, expires_in), raises TokenError with the errcode of gettoken
+        result = self.parseResponse(data)
+        if not result.ok:
+            raise TokenError(result)
+        json_resp = json.loads(data)
+        if "access_token" not in json_resp:
+            raise TokenError(SendResult('provider_error', result.code, 'no access_token', data, True))
+        return((json_resp["access_token"], json_resp.get("expires_in", 7200)))
+
+    def getToken(self, corpid, secret, tokencache=None, rejected=None):
+        #includes connect and request when the token is not in cache
+        cache = getTokenCache(tokencache)
+        with metrics.phase('token'):
+            return(cache.get((corpid, secret), lambda: self.requestToken(corpid, secret), rejected))
+
+    def buildRequest(self,config,msg,token):
+        #handle message
+        title = msg.title
+        body = msg.getBody(self.delimiter)
 
         #load config
-        corpid = config.get('corpid')
-        secret = config.get('secret')
         agentid = config.get('agentid')
         touser = config.get('touser')
         messagetype = config.get('type')
 
-        #initialize header and endpoint
+        #initialize header
         header = {
             "Content-Type": "application/json;charset=UTF-8"
         }
-        # 获取token
-        token = self.getToken(corpid, secret)
-        endpoint = self.endpoint + token
 
         #format posting data
-        message = self.formatMessage(touser, agentid, title, body, messagetype)
+        message = self.formatMessage(touser, agentid, title, body, messagetype, config.get('duplicate_check', 0), config.get('duplicate_check_interval', 1800))
+        postdata = json.dumps(message)
+        postdata = postdata.encode("utf-8")
+        return(request.Request(url=self.endpoint + token, data=postdata, headers=header))
+
+    def pushPart(self,config,msg):
+        #load config
+        corpid = config.get('corpid')
+        secret = config.get('secret')
+        tokencache = config.get('tokencache')
+        if tokencache is not None:
+            tokencache = ConfigLoader().getPath(tokencache)
 
         #send data to wxapp
         try:
-            postdata = json.dumps(message)
-            postdata = postdata.encode("utf-8")
-            handler = request.Request(url=endpoint, data=postdata, headers=header) 
-            resp = request.urlopen(handler) 
-            return(resp.read().decode())
+            # 获取token
+            token = self.getToken(corpid, secret, tokencache)
+        except TokenError as e:
+            return(e.result)
         except HTTPError as e:
-            # do something
-            return('Error code: ', e.code)
+            return(self.parseError(e))
         except URLError as e:
-            # do something
-            return('Reason: ', e.reason)
-        else:
-            # do something
-            return('Unknown exception!')
+            return(SendResult('network_error', None, str(e.reason)))
+        resp = self.send(self.buildRequest(config, msg, token))
+        if self.isTokenRejected(resp):
+            #token is revoked or expired before the time in cache, refresh it and try once more
+            try:
+                token = self.getToken(corpid, secret, tokencache, rejected=token)
+            except TokenError as e:
+                return(e.result)
+            except HTTPError as e:
+                return(self.parseError(e))
+            except URLError as e:
+                return(SendResult('network_error', None, str(e.reason)))
+            resp = self.send(self.buildRequest(config, msg, token))
+        return(resp)
+
+    async def requestTokenAsync(self, corpid, secret):
+        # returns (token, expires_in)
+        resp = await getAsyncTransport().urlopen("https://qyapi.weixin.qq.com/cgi-bin/gettoken?corpid=" + parse.quote(corpid) + "&corpsecret=" + parse.quote(secret))
+        return(self.parseToken(resp.read().decode()))
+
+    async def getTokenAsync(self, corpid, secret, tokencache=None, rejected=None):
+        cache = getTokenCache(tokencache)
+        with metrics.phase('token'):
+            return(await cache.getAsync((corpid, secret), lambda: self.requestTokenAsync(corpid, secret), rejected))
+
+    async def pushPartAsync(self,config,msg):
+        corpid = config.get('corpid')
+        secret = config.get('secret')
+        tokencache = config.get('tokencache')
+        if tokencache is not None:
+            tokencache = ConfigLoader().getPath(tokencache)
+        try:
+            token = await self.getTokenAsync(corpid, secret, tokencache)
+        except TokenError as e:
+            return(e.result)
+        except HTTPError as e:
+            return(self.parseError(e))
+        except URLError as e:
+            return(SendResult('network_error', None, str(e.reason)))
+        resp = await self.sendAsync(self.buildRequest(config, msg, token))
+        if self.isTokenRejected(resp):
+            #token is revoked or expired before the time in cache, refresh it and try once more
+            try:
+                token = await self.getTokenAsync(corpid, secret, tokencache, rejected=token)
+            except TokenError as e:
+                return(e.result)
+            except HTTPError as e:
+                return(self.parseError(e))
+            except URLError as e:
+                return(SendResult('network_error', None, str(e.reason)))
+            resp = await self.sendAsync(self.buildRequest(config, msg, token))
+        return(resp)
+
+    def isTokenRejected(self, resp):
+        return(resp.status == 'provider_error' and resp.code in self.tokenerrors)
 
 #
 # Telegram service
 #
-class Telegram():
+class Telegram(Channel):
     #
     # Telegram instructions: https://core.telegram.org/bots/api#sendmessage
     #
+    configkey = 'telegram'
+    ratelimit = (20, 60)    #20 messages per minute for each group
+    endpointkeys = ('token', 'chatid')
+    requiredkeys = ('token', 'chatid')
+    bodylimit = 4096    #text is at most 4096 chars
+    codekeys = ('error_code', 'ok')    #error_code is only given for errors, otherwise ok is true
+    messagekeys = ('description',)
+    okcodes = (True,)
+    verify = False    #certificate of the server is not verified
+
     def __init__(self):
         self.delimiter = '\n\n'
         self.endpoint = 'https://api.telegram.org/bot'
 
-    def push(self,config,content):
-        #handle message    
-        if(len(content)<2):
-            title = "参数个数不对!"
-            body = "null"
-        else:
-            title = content[0]
-            body = ""
-            for i in range(1,len(content)):
-                v = content[i]
-                v = MessageFormatter().convertBytes(v)
-                v = MessageFormatter().getHostLocation(v)
-                body = body + v + self.delimiter
+    def buildRequest(self,config,msg):
+        #handle message
+        title = msg.title
+        body = msg.getBody(self.delimiter)
 
         #load config
         token = config.get('token')
         chatid = config.get('chatid')
 
-        #initialize endpoint
-        endpoint = self.endpoint + token + "/sendMessage?chat_id=" + str(chatid)
+        #initialize endpoint and header
+        endpoint = self.endpoint + token + "/sendMessage"
+        header = {
+            "Content-Type": "application/json;charset=utf-8"
+        }
 
         #format posting data
-        endpoint = endpoint + "&text=" + parse.quote(title + "\n\n" + body)
+        message = {
+            "chat_id": chatid,
+            "text": title + "\n\n" + body
+        }
+        postdata = json.dumps(message, ensure_ascii=False).encode("utf-8")
 
-        #send data to endpoint
+        return(request.Request(url=endpoint, data=postdata, headers=header))
+
+
+#
+# Rate limits
+#
+priorities = ('low', 'normal', 'high', 'critical')    #lowest first
+
+class TokenBucket():
+    # rate messages per 'per' seconds, up to burst messages at once
+    # messages wait in one queue for each priority, higher priorities are served first
+    # and 'reserved' tokens are kept for critical messages, 20% of burst by default
+
+    # with store, the tokens are kept in a file shared by all the processes using it, under key
+
+    def __init__(self,rate,per,burst=None,reserved=None,store=None,key=None):
+        self.fillrate = float(rate) / per
+        self.capacity = float(burst if burst is not None else rate)
+        if reserved is None:
+            reserved = int(self.capacity * 0.2)
+        #at least one token is left for the other priorities
+        self.reserved = max(0, min(reserved, self.capacity - 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.waiters = dict((priority, collections.deque()) for priority in priorities)
+        self.store = store
+        self.key = key
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fillrate)
+        self.updated = now
+
+    def take(self,needed):
+        # take a token if there are at least needed tokens, called with the lock held
+        if self.store is not None:
+            self.tokens = self.store.take(self.key, self.capacity, self.fillrate, needed)
+        else:
+            self.refill()
+        if self.tokens >= needed:
+            self.tokens -= 1
+            return(True)
+        return(False)
+
+    def getNeeded(self,priority,position):
+        # tokens which must be in the bucket before a message of the priority can take one,
+        # position is the number of messages of the same priority waiting before it
+        rank = priorities.index(priority)
+        ahead = sum(len(self.waiters[p]) for p in priorities[rank + 1:]) + position
+        return(ahead + 1 + (0 if priority == 'critical' else self.reserved))
+
+    def enqueue(self,priority='normal'):
+        # returns a ticket to poll for the token
+        ticket = (priority, object())
+        with self.lock:
+            self.waiters[priority].append(ticket)
+        return(ticket)
+
+    def poll(self,ticket):
+        # take the token of the ticket, returns 0 or the seconds to wait before polling again
+        priority = ticket[0]
+        with self.lock:
+            queue = self.waiters[priority]
+            needed = self.getNeeded(priority, queue.index(ticket))
+            if self.take(needed):
+                queue.remove(ticket)
+                return(0)
+            return((needed - self.tokens) / self.fillrate)
+
+    def cancel(self,ticket):
+        # leave the queue without taking a token
+        with self.lock:
+            try:
+                self.waiters[ticket[0]].remove(ticket)
+            except ValueError:
+                pass
+
+    def tryTake(self,priority='normal'):
+        # take a token without waiting in the queue, returns 0 or the seconds until there will be one
+        with self.lock:
+            needed = self.getNeeded(priority, len(self.waiters[priority]))
+            if self.take(needed):
+                return(0)
+            return((needed - self.tokens) / self.fillrate)
+
+class RateLimitStore():
+    #
+    # tokens of the buckets kept in a sqlite file, so that separate runs of sendmessage.py share the quota
+    # optional settings in config.yml:
+    #   ratelimit:
+    #     path: ratelimit.db
+    #
+    def __init__(self,path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS ratelimit (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def take(self,key,capacity,fillrate,needed):
+        # refill the tokens of key and take one if there are at least needed, returns the tokens before taking
+        now = time.time()
+        with self.lock:
+            #other processes wait for the transaction, so that a token is taken only once
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.db.execute('SELECT tokens, updated FROM ratelimit WHERE key = ?', (key,)).fetchone()
+                tokens = capacity
+                if row is not None:
+                    tokens = min(capacity, row[0] + max(0, now - row[1]) * fillrate)
+                left = tokens - 1 if tokens >= needed else tokens
+                self.db.execute('INSERT OR REPLACE INTO ratelimit (key, tokens, updated) VALUES (?, ?, ?)', (key, left, now))
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        return(tokens)
+
+class RateLimiter():
+    #
+    # token buckets for each channel and endpoint, defaults come from 'ratelimit' of the channel class
+    # optional settings in the section of the channel in config.yml:
+    #   ratelimit:
+    #     rate: 20
+    #     per: 60    #seconds
+    #     burst: 20    #optional, max messages at once, same as rate by default
+    #     mode: wait    #optional, wait or queue (into the outbox)
+    #     reserved: 4    #optional, tokens kept for critical messages, 20% of burst by default
+    #   ratelimit: false    #no rate limit
+    # the buckets are in memory of the process unless store is given, see RateLimitStore
+    #
+    def __init__(self,store=None):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.store = store
+
+    def getSettings(self,handler,config):
+        # returns (rate, per, burst, mode, reserved) or None for no limit
+        settings = config.get('ratelimit')
+        if settings is False or settings == 0:
+            return(None)
+        default = getattr(handler, 'ratelimit', None)
+        if not isinstance(settings, dict):
+            settings = {}
+        rate = settings.get('rate', default[0] if default else None)
+        per = settings.get('per', default[1] if default else 1)
+        if rate is None:
+            return(None)
+        return((rate, per, settings.get('burst'), settings.get('mode', 'wait'), settings.get('reserved')))
+
+    def getBucket(self,service,handler,config):
+        # returns (bucket, mode) or (None, None) for no limit
+        settings = self.getSettings(handler, config)
+        if settings is None:
+            return((None, None))
+        rate, per, burst, mode, reserved = settings
+        key = (service,) + tuple(str(config.get(k)) for k in getattr(handler, 'endpointkeys', ())) + (rate, per, burst, reserved)
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                #urls of the endpoints may have secrets, they are not kept in the store in plain text
+                storekey = hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+                bucket = TokenBucket(rate, per, burst, reserved, self.store, storekey)
+                self.buckets[key] = bucket
+        return((bucket, mode))
+
+    def getWaiting(self):
+        # returns {(service, priority): number of messages waiting for a token}
+        waiting = {}
+        with self.lock:
+            buckets = list(self.buckets.items())
+        for key,bucket in buckets:
+            with bucket.lock:
+                for priority,queue in bucket.waiters.items():
+                    waiting[(key[0], priority)] = waiting.get((key[0], priority), 0) + len(queue)
+        return(waiting)
+
+#
+# Circuit breakers
+#
+class CircuitBreaker():
+    # opens after threshold failures in a row, so that messages fail at once rather than waiting for a dead endpoint
+    # after cooldown seconds one message is let through as a probe (half open), which closes the breaker if it succeeds
+
+    def __init__(self,threshold=5,cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0    #failures in a row
+        self.openeduntil = 0
+        self.probestarted = None
+        self.successes = 0
+        self.errors = 0
+        self.lasterror = None
+        self.lastchange = time.time()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        # returns 0 if a message can be pushed, or the seconds until the next probe
+        with self.lock:
+            if self.state == 'closed':
+                return(0)
+            now = time.monotonic()
+            if self.state == 'open':
+                if now < self.openeduntil:
+                    return(self.openeduntil - now)
+                self.setState('halfopen')
+            #one probe at a time, a probe which never reports back is given up after cooldown
+            if self.probestarted is not None and now - self.probestarted < self.cooldown:
+                return(self.probestarted + self.cooldown - now)
+            self.probestarted = now
+            return(0)
+
+    def succeed(self):
+        with self.lock:
+            self.successes += 1
+            self.failures = 0
+            self.probestarted = None
+            if self.state != 'closed':
+                self.setState('closed')
+
+    def fail(self,error):
+        with self.lock:
+            self.errors += 1
+            self.failures += 1
+            self.lasterror = str(error)
+            self.probestarted = None
+            if self.state == 'halfopen' or self.failures >= self.threshold:
+                self.openeduntil = time.monotonic() + self.cooldown
+                if self.state != 'open':
+                    self.setState('open')
+
+    def setState(self,state):
+        self.state = state
+        self.lastchange = time.time()
+
+    def getHealth(self):
+        with self.lock:
+            return({
+                'state': self.state,
+                'failures': self.failures,
+                'successes': self.successes,
+                'errors': self.errors,
+                'lasterror': self.lasterror,
+                'since': round(self.lastchange, 3)
+            })
+
+def getEndpointLabel(service,handler,config):
+    # short name of the endpoint of a channel, e.g. bark#1a2b3c4d, as endpoints hold tokens and secrets
+    endpoint = tuple(str(config.get(k)) for k in getattr(handler, 'endpointkeys', ()))
+    return(service + '#' + hashlib.sha256(repr(endpoint).encode('utf-8')).hexdigest()[:8])
+
+class CircuitBreakers():
+    #
+    # circuit breakers for each channel and endpoint, like the token buckets of RateLimiter
+    # optional settings in the section of the channel in config.yml:
+    #   circuitbreaker:
+    #     threshold: 5    #failures in a row to open the breaker
+    #     cooldown: 30    #seconds before a probe is let through
+    #   circuitbreaker: false    #no circuit breaker
+    #
+    def __init__(self):
+        self.breakers = {}
+        self.labels = {}
+        self.lock = threading.Lock()
+
+    def getBreaker(self,service,handler,config):
+        # returns the breaker or None
+        settings = config.get('circuitbreaker')
+        if settings is False or settings == 0:
+            return(None)
+        if not isinstance(settings, dict):
+            settings = {}
+        threshold = settings.get('threshold', 5)
+        cooldown = settings.get('cooldown', 30)
+        key = (service,) + tuple(str(config.get(k)) for k in getattr(handler, 'endpointkeys', ()))
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(threshold, cooldown)
+                self.breakers[key] = breaker
+                self.labels[key] = getEndpointLabel(service, handler, config)
+        return(breaker)
+
+    def getHealth(self):
+        # returns {'status': 'ok' or 'degraded', 'endpoints': {label: {...}}}
+        with self.lock:
+            items = list(self.breakers.items())
+        endpoints = {}
+        status = 'ok'
+        for key,breaker in items:
+            health = breaker.getHealth()
+            health['channel'] = key[0]
+            if health['state'] != 'closed':
+                status = 'degraded'
+            endpoints[self.labels[key]] = health
+        return({'status': status, 'endpoints': endpoints})
+
+#
+# Outbox
+#
+def isFailure(resp):
+    # the channels return SendResult, or a list of them for multiple endpoints, channels of other packages may return a tuple for errors
+    if isinstance(resp, list):
+        return(any(isFailure(r) for r in resp))
+    if isinstance(resp, SendResult):
+        return(not resp.ok)
+    return(isinstance(resp, (tuple, BaseException)))
+
+def isTransient(resp):
+    # True if the failure may go away when retried, e.g. network errors rather than wrong settings
+    if isinstance(resp, list):
+        return(any(isTransient(r) for r in resp))
+    if isinstance(resp, SendResult):
+        return(not resp.ok and resp.transient)
+    return(isinstance(resp, (tuple, BaseException)))
+
+class Outbox():
+    #
+    # messages are kept in a sqlite file until they are delivered, failed ones are retried with backoff
+    # and moved to the dead letters of the channel after maxattempts
+    # optional settings in config.yml:
+    #   outbox:
+    #     path: outbox.db
+    #     maxattempts: 8    #optional
+    #     basedelay: 5    #optional, seconds before the first retry, doubled for every retry
+    #     maxdelay: 3600    #optional, max seconds between retries
+    #
+    def __init__(self,path,maxattempts=8,basedelay=5,maxdelay=3600,lease=300):
+        self.path = path
+        self.maxattempts = maxattempts
+        self.basedelay = basedelay
+        self.maxdelay = maxdelay
+        self.lease = lease    #seconds a message is reserved for the sender before it is due again
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=FULL')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            service TEXT NOT NULL,
+            content TEXT NOT NULL,
+            severity TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            nextattempt REAL NOT NULL,
+            dead INTEGER NOT NULL DEFAULT 0,
+            lasterror TEXT,
+            created REAL NOT NULL,
+            part INTEGER NOT NULL DEFAULT 0)""")
+        self.db.execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (dead, nextattempt)')
+        #outbox files of older versions have no part, the index of the first part of a long message not delivered yet
+        if 'part' not in [row[1] for row in self.db.execute('PRAGMA table_info(outbox)')]:
+            self.db.execute('ALTER TABLE outbox ADD COLUMN part INTEGER NOT NULL DEFAULT 0')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def enqueue(self,service,content,severity=None,delay=None):
+        # returns the id of the message, which is reserved for the caller to send it at once,
+        # or for delay seconds, after which it is pushed by the outbox worker if the caller has not done it
+        now = time.time()
+        with self.lock:
+            cursor = self.db.execute('INSERT INTO outbox (service, content, severity, nextattempt, created) VALUES (?, ?, ?, ?, ?)',
+                (service, json.dumps(content), severity, now + (self.lease if delay is None else delay), now))
+            return(cursor.lastrowid)
+
+    def claimDue(self,limit=100):
+        # returns [(id, service, content, severity, attempts, part), ...] which are due, reserved for the caller
+        now = time.time()
+        claimed = []
+        with self.lock:
+            rows = self.db.execute('SELECT id, service, content, severity, attempts, part, nextattempt FROM outbox WHERE dead = 0 AND nextattempt <= ? ORDER BY nextattempt LIMIT ?',
+                (now, limit)).fetchall()
+            for id,service,content,severity,attempts,part,nextattempt in rows:
+                #other processes may share the outbox, only take messages not taken yet
+                cursor = self.db.execute('UPDATE outbox SET nextattempt = ? WHERE id = ? AND nextattempt = ?', (now + self.lease, id, nextattempt))
+                if cursor.rowcount == 1:
+                    claimed.append((id, service, json.loads(content), severity, attempts, part))
+        return(claimed)
+
+    def succeed(self,id):
+        with self.lock:
+            self.db.execute('DELETE FROM outbox WHERE id = ?', (id,))
+
+    def getDelay(self,attempts):
+        # exponential backoff with jitter
+        delay = min(self.maxdelay, self.basedelay * (2 ** (attempts - 1)))
+        return(delay / 2 + random.uniform(0, delay / 2))
+
+    def fail(self,id,error,final=False,part=None):
+        # final is True for failures which retries will not fix, the message goes to the dead letters at once
+        # part is the index of the part of a long message which has failed, retries start from it
+        with self.lock:
+            row = self.db.execute('SELECT attempts FROM outbox WHERE id = ?', (id,)).fetchone()
+            if row is None:
+                return
+            if part is not None:
+                self.db.execute('UPDATE outbox SET part = ? WHERE id = ?', (part, id))
+            attempts = row[0] + 1
+            if attempts >= self.maxattempts or final:
+                self.db.execute('UPDATE outbox SET attempts = ?, dead = 1, lasterror = ? WHERE id = ?', (attempts, str(error), id))
+            else:
+                self.db.execute('UPDATE outbox SET attempts = ?, nextattempt = ?, lasterror = ? WHERE id = ?',
+                    (attempts, time.time() + self.getDelay(attempts), str(error), id))
+
+    def defer(self,id,delay):
+        # push the message later without counting an attempt
+        with self.lock:
+            self.db.execute('UPDATE outbox SET nextattempt = ? WHERE id = ?', (time.time() + delay, id))
+
+    def pending(self,service=None):
+        # number of messages waiting for delivery
+        with self.lock:
+            if service is None:
+                return(self.db.execute('SELECT COUNT(*) FROM outbox WHERE dead = 0').fetchone()[0])
+            return(self.db.execute('SELECT COUNT(*) FROM outbox WHERE dead = 0 AND service = ?', (service,)).fetchone()[0])
+
+    def getCounts(self):
+        # returns [(service, dead, count), ...]
+        with self.lock:
+            return(self.db.execute('SELECT service, dead, COUNT(*) FROM outbox GROUP BY service, dead').fetchall())
+
+    def deadLetters(self,service=None):
+        # returns [(id, service, content, severity, attempts, lasterror), ...]
+        with self.lock:
+            sql = 'SELECT id, service, content, severity, attempts, lasterror FROM outbox WHERE dead = 1'
+            if service is None:
+                rows = self.db.execute(sql + ' ORDER BY id').fetchall()
+            else:
+                rows = self.db.execute(sql + ' AND service = ? ORDER BY id', (service,)).fetchall()
+        return([(r[0], r[1], json.loads(r[2]), r[3], r[4], r[5]) for r in rows])
+
+    def requeueDead(self,service=None):
+        # give dead letters another round of attempts
+        with self.lock:
+            if service is None:
+                cursor = self.db.execute('UPDATE outbox SET dead = 0, attempts = 0, nextattempt = ? WHERE dead = 1', (time.time(),))
+            else:
+                cursor = self.db.execute('UPDATE outbox SET dead = 0, attempts = 0, nextattempt = ? WHERE dead = 1 AND service = ?', (time.time(), service))
+            return(cursor.rowcount)
+
+#
+# Deduplication
+#
+class DedupCache():
+    #
+    # remember the messages pushed to each channel within ttl, so that the same message is pushed only once
+    # optional settings in config.yml:
+    #   dedup:
+    #     ttl: 1800    #seconds
+    #     maxsize: 1024    #optional, max number of messages kept in memory
+    #     path: dedup.db    #optional, shared by all the processes using this file
+    #
+    def __init__(self,ttl=1800,maxsize=1024,path=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        self.inserts = 0
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, expires REAL NOT NULL)')
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+
+    def getKey(self,service,title,body):
+        return(hashlib.sha256(json.dumps([service, title, body]).encode('utf-8')).hexdigest())
+
+    def isDuplicate(self,key):
+        # returns True if the key is seen within ttl, otherwise remembers it and returns False
+        now = time.time()
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is not None and expires > now:
+                self.entries.move_to_end(key)
+                return(True)
+            if self.db is not None:
+                #insert or renew an expired key in one statement, nothing is changed for a duplicate
+                cursor = self.db.execute('INSERT INTO dedup (key, expires) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET expires = excluded.expires WHERE dedup.expires <= ?',
+                    (key, now + self.ttl, now))
+                if cursor.rowcount == 0:
+                    expires = self.db.execute('SELECT expires FROM dedup WHERE key = ?', (key,)).fetchone()
+                    self.remember(key, expires[0] if expires else now + self.ttl)
+                    return(True)
+                self.inserts += 1
+                if self.inserts % 1000 == 0:
+                    self.db.execute('DELETE FROM dedup WHERE expires <= ?', (now,))
+            self.remember(key, now + self.ttl)
+            return(False)
+
+    def remember(self,key,expires):
+        self.entries[key] = expires
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def forget(self,key):
+        # e.g. the push failed, so that the same message can be pushed again
+        with self.lock:
+            self.entries.pop(key, None)
+            if self.db is not None:
+                self.db.execute('DELETE FROM dedup WHERE key = ?', (key,))
+
+#
+# Coalescing
+#
+class Coalescer():
+    #
+    # during alert storms, the first message of a key is pushed at once, and the other messages with
+    # the same key within the window are pushed as one digest at the end of the window
+    # optional settings in config.yml:
+    #   coalesce:
+    #     window: 10    #seconds
+    #     key: "^(\\S+)"    #optional, regexp on title, the first group (or the match) is the key, title by default
+    #     maxbodies: 3    #optional, max number of messages whose lines are in the digest
+    # with outbox, held messages are kept in it until the digest is pushed, so that they are pushed one by one
+    # by the outbox worker if the process stops before
+    #
+    def __init__(self,dispatcher,settings):
+        self.dispatcher = dispatcher
+        self.window = settings.get('window', 10)
+        self.maxbodies = settings.get('maxbodies', 3)
+        key = settings.get('key')
+        self.keypattern = re.compile(key) if key is not None else None
+        self.groups = {}
+        self.lock = threading.Lock()
+
+    def getKey(self,title):
+        if self.keypattern is None:
+            return(title)
+        m = self.keypattern.search(title)
+        if m is None:
+            return(title)
+        if m.groups():
+            return(m.group(1))
+        return(m.group())
+
+    def submit(self,content,severity=None):
+        # returns the results of dispatch, or [('coalesce', ...)] if the message is held for the digest
+        msg = Message.fromContent(content)
+        key = (self.getKey(msg.title), severity)
+        with self.lock:
+            group = self.groups.get(key)
+            if group is not None:
+                group['count'] += 1
+                group['last'] = time.time()
+                if len(group['messages']) < self.maxbodies:
+                    group['messages'].append(msg)
+                outbox = self.dispatcher.outbox
+                if outbox is not None:
+                    for name in self.dispatcher.getNames(msg, severity):
+                        group['ids'].append(outbox.enqueue(name, msg.content, severity, self.window + outbox.lease))
+                return([('coalesce', 'held for digest')])
+            self.groups[key] = {'title': msg.title, 'count': 0, 'messages': [], 'ids': [], 'first': time.time(), 'last': None}
+            timer = threading.Timer(self.window, self.flushKey, args=(key,))
+            timer.daemon = True
+            timer.start()
+        return(self.dispatcher.dispatch(msg, severity))
+
+    def getDigest(self,group):
+        # the digest is a normal message, so the body limit of each channel applies to it
+        count = group['count']
+        lines = [str(count) + ' more messages from ' + time.strftime('%H:%M:%S', time.localtime(group['first'])) + ' to ' + time.strftime('%H:%M:%S', time.localtime(group['last']))]
+        for i,msg in enumerate(group['messages']):
+            lines.append('#' + str(i + 1) + ' ' + msg.title)
+            if msg.lines is not None:
+                lines.extend(msg.lines)
+        if count > len(group['messages']):
+            lines.append('... and ' + str(count - len(group['messages'])) + ' more')
+        return(Message([group['title'] + ' (+' + str(count) + ')'] + lines))
+
+    def flushKey(self,key):
+        # called at the end of the window
+        if not self.dispatcher.acquire():
+            #closed, the digests are pushed by flush
+            return
         try:
-            #print(endpoint)
-            ssl._create_default_https_context = ssl._create_unverified_context
-            resp = request.urlopen(endpoint)
-            return(resp.read().decode())
-        except HTTPError as e:
-            # do something
-            return('Error code: ', e.code)
-        except URLError as e:
-            # do something
-            return('Reason: ', e.reason)
+            self.pushDigest(key)
+        finally:
+            self.dispatcher.release()
+
+    def pushDigest(self,key):
+        with self.lock:
+            group = self.groups.pop(key, None)
+        if group is not None and group['count'] > 0:
+            self.dispatcher.dispatch(self.getDigest(group), key[1])
+            #the digest is in the outbox by itself
+            for id in group['ids']:
+                self.dispatcher.outbox.succeed(id)
+
+    def flush(self):
+        # push all the digests now, e.g. before exit
+        with self.lock:
+            keys = list(self.groups.keys())
+        for key in keys:
+            self.pushDigest(key)
+
+#
+# Channel registry
+#
+class ChannelRegistry():
+    #
+    # config key -> channel class, the modules required by a channel are imported only when it is configured
+    # channels of other packages are found by entry points of group 'sendmessage.channels', e.g. in pyproject.toml:
+    #   [project.entry-points."sendmessage.channels"]
+    #   mychannel = "mypackage.mymodule:MyChannel"
+    # MyChannel (usually a subclass of Channel) is the handler of section 'mychannel' in config.yml
+    #
+    group = 'sendmessage.channels'
+    settings = ('dispatcher', 'transport', 'routing', 'outbox', 'dedup', 'coalesce', 'priority', 'metrics', 'ratelimit')    #config keys which are not channels
+
+    def __init__(self):
+        self.channels = {}
+        self.loaded = set()
+        self.entrypoints = None
+
+    def register(self,channel,key=None):
+        # channel is a class, or 'module:class' which is imported when the channel is configured
+        if key is None:
+            key = channel.configkey
+        self.channels[key] = channel
+        self.loaded.discard(key)
+
+    def loadEntryPoints(self):
+        # entry points are read only when a config key is not a built-in channel
+        if self.entrypoints is None:
+            self.entrypoints = {}
+            try:
+                import importlib.metadata
+                for entrypoint in importlib.metadata.entry_points(group=self.group):
+                    self.entrypoints[entrypoint.name] = entrypoint
+            except Exception as e:
+                print('channel entry points: ' + repr(e), file=sys.stderr)
+        return(self.entrypoints)
+
+    def get(self,key):
+        # returns the channel class of the config key, or None
+        if key in self.settings:
+            return(None)
+        if key not in self.channels:
+            entrypoint = self.loadEntryPoints().get(key)
+            if entrypoint is None:
+                return(None)
+            self.channels[key] = entrypoint.load()
+        channel = self.channels[key]
+        if key not in self.loaded:
+            if isinstance(channel, str):
+                modulename, _, classname = channel.partition(':')
+                channel = getattr(importlib.import_module(modulename), classname)
+                self.channels[key] = channel
+            for modulename in getattr(channel, 'requires', ()):
+                importlib.import_module(modulename)
+            self.loaded.add(key)
+        return(channel)
+
+registry = ChannelRegistry()
+for channelclass in (Bark, ServerChan, PushPlus, Iyuu, SMTP, DingTalk, FeiShu, WxBot, WxApp, Telegram):
+    registry.register(channelclass)
+
+
+#
+# Dispatcher
+#
+class Dispatcher():
+    #
+    # push one message to all configured services concurrently
+    # optional settings in config.yml:
+    #   dispatcher:
+    #     maxworkers: 10    #max number of services pushed at the same time, by all the messages together
+    #     timeout: 30    #max seconds to wait for each service
+    #   metrics:    #optional, see Metrics
+    #     path: metrics.prom
+    #   priority:    #optional, priority of the messages of each severity, on top of the defaults below
+    #     warning: normal
+    # messages of higher priority take the tokens of rate limits first
+    # previous is the dispatcher of the config before reload, whose rate limits (and outbox, dedup cache and workers if unchanged) are kept
+    # a dispatcher replaced by reload is closed, it is shut down once the messages being pushed by it are done
+    #
+    severities = {
+        'critical': 'critical',
+        'emergency': 'critical',
+        'alert': 'critical',
+        'error': 'high',
+        'high': 'high',
+        'warning': 'high',
+        'low': 'low',
+        'debug': 'low',
+        'bulk': 'low',
+    }
+
+    def __init__(self,config,previous=None):
+        self.config = config
+        settings = config.get('dispatcher') or {}
+        self.maxworkers = settings.get('maxworkers', 10)
+        self.timeout = settings.get('timeout', 30)
+        self.priorities = dict(self.severities)
+        self.priorities.update(config.get('priority') or {})
+        transport.configure(config.get('transport') or {})
+        metrics.configure(config.get('metrics') or {})
+        self.router = Router(config.get('routing'), config)
+        self.breakers = CircuitBreakers()
+        if previous is not None:
+            self.breakers = previous.breakers
+        ratelimitsettings = config.get('ratelimit')
+        if previous is not None and ratelimitsettings == previous.config.get('ratelimit'):
+            #buckets are kept for each endpoint and limit, so the quota used before reload still counts
+            self.ratelimiter = previous.ratelimiter
+        elif ratelimitsettings is not None and ratelimitsettings.get('path') is not None:
+            self.ratelimiter = RateLimiter(RateLimitStore(ConfigLoader().getPath(ratelimitsettings.get('path'))))
+        else:
+            self.ratelimiter = RateLimiter()
+        #one pool of workers for all the messages, threads are started once and reused
+        if previous is not None and previous.maxworkers == self.maxworkers:
+            self.executor = previous.executor
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.maxworkers, thread_name_prefix='sendmessage')
+        self.lock = threading.Lock()
+        self.users = 0
+        self.closed = False
+        self.successor = None
+        self.dedup = None
+        dedupsettings = config.get('dedup')
+        if previous is not None and previous.dedup is not None and dedupsettings == previous.config.get('dedup'):
+            self.dedup = previous.dedup
+        elif dedupsettings is not None:
+            path = dedupsettings.get('path')
+            if path is not None:
+                path = ConfigLoader().getPath(path)
+            self.dedup = DedupCache(dedupsettings.get('ttl', 1800), dedupsettings.get('maxsize', 1024), path)
+        self.coalescer = None
+        if config.get('coalesce') is not None:
+            self.coalescer = Coalescer(self, config.get('coalesce'))
+        self.outbox = None
+        self.worker = None
+        self.stopping = threading.Event()
+        outboxsettings = config.get('outbox')
+        if previous is not None and previous.outbox is not None and outboxsettings == previous.config.get('outbox'):
+            self.outbox = previous.outbox
+        elif outboxsettings is not None:
+            self.outbox = Outbox(ConfigLoader().getPath(outboxsettings.get('path', 'outbox.db')),
+                outboxsettings.get('maxattempts', 8), outboxsettings.get('basedelay', 5), outboxsettings.get('maxdelay', 3600))
+        #keep handler instances so that they can be reused for every message
+        #channels which are only configured in routing overrides get handlers too
+        self.handlers = {}
+        #channel classes come from the registry, so only the configured channels are loaded
+        for service in config:
+            channel = registry.get(service)
+            if channel is not None:
+                self.handlers[service] = channel()
+        for rule in self.router.rules:
+            for service in list((rule.get('overrides') or {}).keys()):
+                if service not in self.handlers:
+                    channel = registry.get(service)
+                    if channel is not None:
+                        self.handlers[service] = channel()
+        #indexes, signing keys etc. are built before the first message
+        for service,handler in self.handlers.items():
+            if config.get(service) is not None and hasattr(handler, 'prepare'):
+                handler.prepare(config[service])
+        for configs in self.router.configs:
+            for service,serviceconfig in configs.items():
+                if service in self.handlers and hasattr(self.handlers[service], 'prepare'):
+                    self.handlers[service].prepare(serviceconfig)
+        if len(self.router.rules) > 0:
+            self.router.getIndex(None)
+
+    def getPriority(self,severity):
+        # priority of the messages of a severity, normal if not known
+        return(self.priorities.get(severity, 'normal'))
+
+    def takeToken(self,service,config,outboxid=None,priority='normal'):
+        # returns (waiter, resp) where waiter is (bucket, ticket) to wait for rate limit,
+        # or resp is not None if the message is deferred in the outbox
+        bucket, mode = self.ratelimiter.getBucket(service, self.handlers[service], config)
+        if bucket is None:
+            return((None, None))
+        if mode == 'queue' and outboxid is not None:
+            delay = bucket.tryTake(priority)
+            if delay > 0:
+                #leave it to the outbox worker
+                self.outbox.defer(outboxid, delay)
+                return((None, SendResult('deferred', None, 'rate limit, retry in ' + str(round(delay, 1)) + 's')))
+            return((None, None))
+        return(((bucket, bucket.enqueue(priority)), None))
+
+    def pollToken(self,waiter):
+        # returns 0 if the token is taken or there is no rate limit, otherwise the seconds to wait before polling again
+        if waiter is None:
+            return(0)
+        bucket, ticket = waiter
+        return(bucket.poll(ticket))
+
+    def cancelToken(self,waiter):
+        # leave the queue of the bucket, e.g. interrupted, so that the messages behind it do not wait for it
+        if waiter is not None:
+            bucket, ticket = waiter
+            bucket.cancel(ticket)
+
+    def checkBreaker(self,service,config,outboxid=None):
+        # returns (breaker, resp) where resp is not None if the endpoint is skipped because its breaker is open
+        breaker = self.breakers.getBreaker(service, self.handlers[service], config)
+        if breaker is None:
+            return((None, None))
+        delay = breaker.allow()
+        if delay == 0:
+            return((breaker, None))
+        if outboxid is not None:
+            #pushed by the outbox worker when the breaker lets a probe through
+            self.outbox.defer(outboxid, delay)
+            return((breaker, SendResult('deferred', None, 'circuit open, retry in ' + str(round(delay, 1)) + 's')))
+        return((breaker, SendResult('circuit_open', None, 'retry in ' + str(round(delay, 1)) + 's')))
+
+    def getHealth(self):
+        health = self.breakers.getHealth()
+        if self.outbox is not None:
+            health['outbox'] = {'pending': self.outbox.pending()}
+        return(health)
+
+    def getMetrics(self):
+        # prometheus text of the metrics, with the gauges of outbox, rate limits and circuit breakers up to date
+        if self.outbox is not None:
+            metrics.setGauges('sendmessage_outbox_messages', dict(((('channel', service), ('state', 'dead' if dead else 'pending')), count) for service,dead,count in self.outbox.getCounts()))
+        metrics.setGauges('sendmessage_ratelimit_waiting', dict(((('channel', service), ('priority', priority)), count) for (service,priority),count in self.ratelimiter.getWaiting().items()))
+        endpoints = self.breakers.getHealth()['endpoints']
+        metrics.setGauges('sendmessage_circuit_open', dict(((('channel', health['channel']), ('endpoint', label)), 0 if health['state'] == 'closed' else 1) for label,health in endpoints.items()))
+        return(metrics.render())
+
+    def writeMetrics(self):
+        # write the metrics to 'path' of the metrics settings if given
+        path = (self.config.get('metrics') or {}).get('path')
+        if path is None:
+            return
+        try:
+            metrics.write(ConfigLoader().getPath(path), self.getMetrics())
+        except OSError as e:
+            print('metrics: ' + repr(e), file=sys.stderr)
+
+    def getResult(self,resp,service,config,msg,latency=None):
+        # SendResult of a push with latency, attempts and endpoint, or a list of them for multiple endpoints
+        if isinstance(resp, list):
+            return([self.getResult(r, service, config, msg, latency) for r in resp])
+        result = SendResult.fromValue(resp)
+        result.latency = latency
+        result.attempts = msg.attempts
+        result.endpoint = getEndpointLabel(service, self.handlers[service], config)
+        return(result)
+
+    def record(self,resp,outboxid=None,dedupkey=None,breaker=None):
+        # keep outbox, dedup cache and circuit breaker up to date with the result of a push, resp may be an exception
+        failed = isinstance(resp, BaseException) or isFailure(resp)
+        if breaker is not None:
+            if failed and isTransient(resp):
+                breaker.fail(repr(resp) if isinstance(resp, BaseException) else formatResult(resp))
+            else:
+                #the endpoint has answered, e.g. with an error of wrong settings
+                breaker.succeed()
+        if dedupkey is not None and failed:
+            #not delivered, the same message can be pushed again
+            self.dedup.forget(dedupkey)
+        if outboxid is not None:
+            if isinstance(resp, BaseException):
+                self.outbox.fail(outboxid, repr(resp))
+            elif failed:
+                #errors which retries will not fix go to the dead letters at once
+                self.outbox.fail(outboxid, formatResult(resp), not isTransient(resp), getattr(resp, 'part', None))
+            else:
+                self.outbox.succeed(outboxid)
+
+    def admit(self,service,config,msg,outboxid=None,dedupkey=None):
+        # returns (breaker, waiter, resp) where waiter is to wait for rate limit,
+        # or resp is not None if the message is not pushed, e.g. circuit open or deferred
+        breaker, resp = self.checkBreaker(service, config, outboxid)
+        waiter = None
+        if resp is None:
+            waiter, resp = self.takeToken(service, config, outboxid, msg.priority)
+        if resp is not None:
+            resp = self.getResult(resp, service, config, msg)
+            metrics.count(service, resp)
+            if outboxid is None:
+                self.record(resp, None, dedupkey)
+        return((breaker, waiter, resp))
+
+    def call(self,name,service,config,msg,started,outboxid=None,dedupkey=None,breaker=None):
+        # push in a worker once the message is admitted and the token of rate limit is taken
+        #waiting for rate limit is not counted in the timeout
+        started[name] = time.monotonic()
+        timer = metrics.startPush(service)
+        try:
+            resp = self.handlers[service].push(config, msg)
+        except Exception as e:
+            metrics.finishPush(timer, e)
+            self.record(e, outboxid, dedupkey, breaker)
+            raise
+        resp = self.getResult(resp, service, config, msg, time.monotonic() - started[name])
+        metrics.finishPush(timer, resp)
+        self.record(resp, outboxid, dedupkey, breaker)
+        return(resp)
+
+    def callBatch(self,name,service,config,batch):
+        # push messages of the outbox for the same endpoint with one pushBatch of the channel, batch is [(msg, outboxid), ...]
+        admitted = []
+        for msg,outboxid in batch:
+            breaker, waiter, resp = self.admit(service, config, msg, outboxid)
+            if resp is not None:
+                continue
+            try:
+                wait = self.pollToken(waiter)
+                while wait > 0:
+                    time.sleep(wait)
+                    wait = self.pollToken(waiter)
+            except BaseException:
+                self.cancelToken(waiter)
+                raise
+            admitted.append((msg, outboxid, breaker))
+        if len(admitted) == 0:
+            return
+        started = time.monotonic()
+        timer = metrics.startPush(service)
+        try:
+            resps = self.handlers[service].pushBatch(config, [msg for msg,outboxid,breaker in admitted])
+        except Exception as e:
+            metrics.finishPush(timer, e)
+            for msg,outboxid,breaker in admitted:
+                self.record(e, outboxid, None, breaker)
+            raise
+        latency = time.monotonic() - started
+        resps = [self.getResult(resp, service, config, msg, latency) for resp,(msg,outboxid,breaker) in zip(resps, admitted)]
+        #one push of the channel, the other messages of the batch are only counted
+        metrics.finishPush(timer, resps[0])
+        for resp in resps[1:]:
+            metrics.count(service, resp)
+        for resp,(msg,outboxid,breaker) in zip(resps, admitted):
+            self.record(resp, outboxid, None, breaker)
+
+    def getTargets(self,msg,severity):
+        # returns (channels, targets, results) where targets are [(service, config), ...] to push
+        # and results hold the channels which can not be pushed
+        channels, configs = self.router.route(msg.title, severity)
+        if channels is None:
+            channels = [service for service in self.handlers if service in self.config]
+        targets = []
+        results = {}
+        for service in channels:
+            if service in configs:
+                targets.append((service, configs[service]))
+            elif service in self.handlers and self.config.get(service) is not None:
+                targets.append((service, self.config[service]))
+            else:
+                results[service] = SendResult('not_configured', None, 'channel not configured')
+        return((channels, targets, results))
+
+    def run(self,jobs):
+        # jobs are [(name, service, config, msg, outboxid, dedupkey), ...] with different names,
+        # name is the service, or the endpoint label for services split into endpoints
+        # returns {name: resp}
+        results = {}
+        started = {}
+        futures = []
+        waiting = []
+        try:
+            for name,service,config,msg,outboxid,dedupkey in jobs:
+                breaker, waiter, resp = self.admit(service, config, msg, outboxid, dedupkey)
+                if resp is not None:
+                    results[name] = resp
+                else:
+                    waiting.append((waiter, (name, service, config, msg, started, outboxid, dedupkey, breaker)))
+            #rate limits are waited for by this thread, so that the workers are taken only by pushes
+            while len(waiting) > 0:
+                later = []
+                for waiter,args in waiting:
+                    wait = self.pollToken(waiter)
+                    if wait > 0:
+                        later.append((wait, waiter, args))
+                    else:
+                        futures.append((args[0], self.executor.submit(self.call, *args)))
+                waiting = [(waiter, args) for wait,waiter,args in later]
+                if len(later) > 0:
+                    time.sleep(min(wait for wait,waiter,args in later))
+        except BaseException:
+            for waiter,args in waiting:
+                self.cancelToken(waiter)
+            raise
+        for name,future in futures:
+            done = False
+            while not done:
+                #timeout of each service is counted from the time it starts running rather than waiting in the pool
+                if name in started:
+                    remaining = started[name] + self.timeout - time.monotonic()
+                else:
+                    remaining = self.timeout
+                try:
+                    resp = future.result(timeout=max(0, remaining))
+                    done = True
+                except concurrent.futures.TimeoutError:
+                    #the worker is left to finish the push which is timed out
+                    if name in started:
+                        resp = SendResult('timeout', None, str(self.timeout) + 's')
+                        resp.endpoint = name
+                        metrics.increment('sendmessage_timeouts_total', (('channel', name.split('#')[0]),))
+                        done = True
+                except Exception as e:
+                    resp = SendResult('exception', None, repr(e))
+                    resp.endpoint = name
+                    done = True
+            results[name] = resp
+        return(results)
+
+    def getParts(self,service,config):
+        # returns [(name, config), ...] of the endpoints of a service which are pushed as separate jobs,
+        # so that each of them has its own result, breaker, rate limit and outbox entry
+        handler = self.handlers[service]
+        parts = handler.splitConfig(config) if hasattr(handler, 'splitConfig') else [config]
+        if len(parts) == 1 and parts[0] is config:
+            return(None)
+        return([(getEndpointLabel(service, handler, part), part) for part in parts])
+
+    def getNames(self,msg,severity):
+        # names of the services and endpoints the message is pushed to, as kept in the outbox
+        channels, targets, results = self.getTargets(msg, severity)
+        names = []
+        for service,config in targets:
+            parts = self.getParts(service, config)
+            if parts is None:
+                names.append(service)
+            else:
+                names.extend([name for name,part in parts])
+        return(names)
+
+    def prepareJobs(self,msg,severity):
+        # returns (channels, jobs, results, parts) where jobs are [(name, service, config, msg, outboxid, dedupkey), ...] to push,
+        # results hold the channels which are not pushed, and parts hold the names of the services split into endpoints
+        channels, targets, results = self.getTargets(msg, severity)
+        jobs = []
+        parts = {}
+        for service,config in targets:
+            names = self.getParts(service, config)
+            if names is None:
+                names = [(service, config)]
+            else:
+                parts[service] = [name for name,config in names]
+            for name,config in names:
+                dedupkey = None
+                if self.dedup is not None:
+                    #duplicates are dropped before any network i/o
+                    dedupkey = self.dedup.getKey(name, msg.title, msg.getBody(self.handlers[service].delimiter))
+                    if self.dedup.isDuplicate(dedupkey):
+                        results[name] = SendResult('duplicate', None, 'suppressed')
+                        metrics.count(service, results[name])
+                        continue
+                outboxid = None
+                if self.outbox is not None:
+                    #kept until delivered, failed pushes are retried by the outbox worker
+                    outboxid = self.outbox.enqueue(name, msg.content, severity)
+                    #retried by the outbox, no need to forget the message in dedup cache when it fails
+                    dedupkey = None
+                jobs.append((name, service, config, msg, outboxid, dedupkey))
+        return((channels, jobs, results, parts))
+
+    def getResults(self,channels,results,parts):
+        # returns [(service, resp), ...] where resp of a service split into endpoints is the list of their results
+        for service,names in parts.items():
+            results[service] = [results[name] for name in names]
+        return([(service, results[service]) for service in channels])
+
+    def dispatch(self,content,severity=None):
+        # returns [(service, resp), ...] in the same order as in config or in the matching routing rule
+        #the message is formatted once for all the channels
+        msg = Message.fromContent(content)
+        msg.priority = self.getPriority(severity)
+        channels, jobs, results, parts = self.prepareJobs(msg, severity)
+        results.update(self.run(jobs))
+        return(self.getResults(channels, results, parts))
+
+    def submit(self,content,severity=None):
+        # same as dispatch, but messages may be coalesced into digests if configured
+        if self.coalescer is None:
+            return(self.dispatch(content, severity))
+        return(self.coalescer.submit(content, severity))
+
+    def drainOutbox(self):
+        # push the messages in the outbox which are due for retry, returns the number of them
+        if self.outbox is None:
+            return(0)
+        rows = self.outbox.claimDue()
+        count = len(rows)
+        #one job for each service or endpoint at a time
+        while len(rows) > 0:
+            jobs = []
+            batches = {}
+            later = []
+            names = set()
+            for id,name,content,severity,attempts,part in rows:
+                if name in names:
+                    later.append((id, name, content, severity, attempts, part))
+                    continue
+                msg = Message(content)
+                msg.priority = self.getPriority(severity)
+                msg.attempts = attempts + 1
+                msg.firstpart = part
+                channels, configs = self.router.route(msg.title, severity)
+                #endpoints of a service split into endpoints are kept as service#label
+                service = name.split('#')[0]
+                config = configs.get(service) or self.config.get(service)
+                if service not in self.handlers or config is None:
+                    self.outbox.fail(id, 'channel not configured')
+                    continue
+                if name != service:
+                    config = dict(self.getParts(service, config) or []).get(name)
+                    if config is None:
+                        self.outbox.fail(id, 'endpoint not configured')
+                        continue
+                if name in batches and batches[name][1] != config:
+                    #settings overridden by another rule, pushed in the next round
+                    later.append((id, name, content, severity, attempts, part))
+                    continue
+                metrics.increment('sendmessage_retries_total', (('channel', service),))
+                if hasattr(self.handlers[service], 'pushBatch'):
+                    #messages for the same endpoint are pushed in one batch, e.g. on one smtp session
+                    batches.setdefault(name, (service, config, []))[2].append((msg, id))
+                    continue
+                names.add(name)
+                jobs.append((name, service, config, msg, id, None))
+            futures = [self.executor.submit(self.callBatch, name, service, config, batch) for name,(service,config,batch) in batches.items()]
+            self.run(jobs)
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    #the failure is recorded in the outbox already
+                    print('outbox: ' + repr(e), file=sys.stderr)
+            rows = later
+        return(count)
+
+    def startWorker(self,interval=1):
+        # retry the messages in the outbox in background
+        if self.outbox is None or self.worker is not None:
+            return
+        self.worker = threading.Thread(target=self.workerLoop, args=(interval,), daemon=True)
+        self.worker.start()
+
+    def stopWorker(self):
+        # the worker stops after the messages it is retrying, messages not claimed yet are left to the next worker
+        if self.worker is not None:
+            self.stopping.set()
+
+    def workerLoop(self,interval):
+        while not self.stopping.is_set():
+            if not self.acquire():
+                break
+            try:
+                self.drainOutbox()
+            except Exception as e:
+                print('outbox: ' + repr(e), file=sys.stderr)
+            finally:
+                self.release()
+            self.stopping.wait(interval)
+
+    def acquire(self):
+        # returns False if the dispatcher is closed, otherwise it is not shut down until release
+        with self.lock:
+            if self.closed:
+                return(False)
+            self.users += 1
+            return(True)
+
+    def release(self):
+        with self.lock:
+            self.users -= 1
+            done = self.closed and self.users == 0
+        if done:
+            self.shutdown()
+
+    def close(self,successor=None):
+        # e.g. replaced by reload or before exit, shut down once the messages being pushed are done,
+        # the resources taken over by successor are kept
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.successor = successor
+            self.users += 1
+        #held messages are pushed now rather than at the end of their window
+        if self.coalescer is not None:
+            self.coalescer.flush()
+        self.release()
+
+    def shutdown(self):
+        self.stopWorker()
+        successor = self.successor
+        if successor is None or successor.executor is not self.executor:
+            #do not wait for services which are timed out
+            self.executor.shutdown(wait=False)
+        #files which are not taken over by successor are closed
+        if self.outbox is not None and (successor is None or successor.outbox is not self.outbox):
+            self.outbox.close()
+        if self.dedup is not None and (successor is None or successor.dedup is not self.dedup):
+            self.dedup.close()
+        store = self.ratelimiter.store
+        if store is not None and (successor is None or successor.ratelimiter.store is not store):
+            store.close()
+
+
+#
+# Asyncio dispatcher
+#
+class AsyncDispatcher():
+    #
+    # same as Dispatcher for asyncio, all the channels are pushed concurrently on the running event loop
+    #   dispatcher = sendmessage.AsyncDispatcher(config)
+    #   results = await dispatcher.dispatch(["subject","ln1","ln2"])
+    # handlers, routing, rate limits, dedup and outbox are shared with the Dispatcher in self.dispatcher
+    # failed pushes in the outbox are retried by the outbox worker thread of self.dispatcher until close
+    #
+    def __init__(self,config):
+        self.dispatcher = Dispatcher(config)
+        self.dispatcher.startWorker()
+
+    async def runBlocking(self,func,*args):
+        # outbox, dedup file and rate limit store are sqlite, their i/o is done off the event loop
+        dispatcher = self.dispatcher
+        if dispatcher.outbox is None and (dispatcher.dedup is None or dispatcher.dedup.db is None) and dispatcher.ratelimiter.store is None:
+            return(func(*args))
+        return(await asyncio.get_running_loop().run_in_executor(None, contextvars.copy_context().run, func, *args))
+
+    async def call(self,service,config,msg,outboxid=None,dedupkey=None):
+        dispatcher = self.dispatcher
+        breaker, waiter, resp = await self.runBlocking(dispatcher.admit, service, config, msg, outboxid, dedupkey)
+        if resp is not None:
+            return(resp)
+        if waiter is not None:
+            #the bucket may wait for other processes on the rate limit store
+            try:
+                wait = await self.runBlocking(dispatcher.pollToken, waiter)
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = await self.runBlocking(dispatcher.pollToken, waiter)
+            except BaseException:
+                #e.g. cancelled, the messages behind it should not wait for it
+                await self.runBlocking(dispatcher.cancelToken, waiter)
+                raise
+        #waiting for rate limit is not counted in the timeout
+        timer = metrics.startPush(service)
+        started = time.monotonic()
+        try:
+            resp = await asyncio.wait_for(dispatcher.handlers[service].pushAsync(config, msg), dispatcher.timeout)
+        except asyncio.TimeoutError:
+            resp = SendResult('timeout', None, str(dispatcher.timeout) + 's')
+            metrics.increment('sendmessage_timeouts_total', (('channel', service),))
+        except Exception as e:
+            metrics.finishPush(timer, e)
+            await self.runBlocking(dispatcher.record, e, outboxid, dedupkey, breaker)
+            return(dispatcher.getResult(e, service, config, msg, time.monotonic() - started))
+        resp = dispatcher.getResult(resp, service, config, msg, time.monotonic() - started)
+        metrics.finishPush(timer, resp)
+        await self.runBlocking(dispatcher.record, resp, outboxid, dedupkey, breaker)
+        return(resp)
+
+    async def dispatch(self,content,severity=None):
+        # returns [(service, resp), ...] in the same order as in config or in the matching routing rule
+        msg = Message.fromContent(content)
+        msg.priority = self.dispatcher.getPriority(severity)
+        channels, jobs, results, parts = await self.runBlocking(self.dispatcher.prepareJobs, msg, severity)
+        resps = await asyncio.gather(*[self.call(service, config, msg, outboxid, dedupkey) for name,service,config,msg,outboxid,dedupkey in jobs])
+        for (name,service,config,msg,outboxid,dedupkey),resp in zip(jobs, resps):
+            results[name] = resp
+        return(self.dispatcher.getResults(channels, results, parts))
+
+    def close(self):
+        # stop the outbox worker, e.g. before the event loop is closed
+        self.dispatcher.close()
+
+
+#
+# Stream mode
+#
+class Streamer():
+    #
+    # push many messages in one process, one json record per line from stdin or a file:
+    #   ["title","line 1","line 2"]
+    #   {"title": "title", "lines": ["line 1","line 2"], "severity": "critical"}
+    #   {"content": ["title","line 1","line 2"], "severity": "critical"}
+    # one json line is written for each channel of each message as soon as the message is pushed:
+    #   {"line": 1, "channel": "dingtalk", "ok": true, "result": "ok 0: ok", "status": "ok", "code": 0, "message": "ok",
+    #    "latency": 0.12, "attempts": 1, "endpoint": "dingtalk#8bb0b87e"}
+    # channels split into endpoints, e.g. bark with multiple endpoints, have the same fields for each endpoint in "results"
+    # input is read only when there is room for more messages in flight, so memory does not grow with the input
+    #   python3 sendmessage.py --stream=messages.jsonl
+    #   cat messages.jsonl | python3 sendmessage.py --stream=-
+    # optional settings in config.yml:
+    #   dispatcher:
+    #     maxinflight: 16    #max number of messages pushed at the same time
+    #
+    def __init__(self,dispatcher,output):
+        self.dispatcher = dispatcher
+        self.output = output
+        self.maxinflight = (dispatcher.config.get('dispatcher') or {}).get('maxinflight', 16)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.failed = 0
+
+    def parseRecord(self,line):
+        # returns (content, severity)
+        data = json.loads(line)
+        severity = None
+        if isinstance(data, dict):
+            severity = data.get('severity')
+            if severity is not None and not isinstance(severity, str):
+                raise ValueError('severity should be a string')
+            if 'content' in data:
+                data = data.get('content')
+            else:
+                title = data.get('title')
+                if title is None:
+                    raise ValueError('title or content is required')
+                lines = data.get('lines') or []
+                if not isinstance(lines, list):
+                    raise ValueError('lines should be a list')
+                data = [title] + lines
+        if not isinstance(data, list) or len(data) == 0:
+            raise ValueError('content should be a non-empty list')
+        for v in data:
+            if not isinstance(v, (str, int, float)):
+                raise ValueError('title and lines should be strings or numbers')
+        return(([str(v) for v in data], severity))
+
+    def write(self,records):
+        # records of one message are written together
+        with self.lock:
+            for record in records:
+                self.output.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.output.flush()
+
+    def push(self,lineno,content,severity):
+        try:
+            results = self.dispatcher.dispatch(content, severity)
+        except Exception as e:
+            results = [('', SendResult('exception', None, repr(e)))]
+        failed = False
+        records = []
+        for service,resp in results:
+            ok = not isFailure(resp)
+            failed = failed or not ok
+            record = {'line': lineno, 'channel': service, 'ok': ok, 'result': formatResult(resp)}
+            if isinstance(resp, SendResult):
+                record.update(resp.toDict())
+            elif isinstance(resp, list):
+                record['results'] = [r.toDict() for r in resp if isinstance(r, SendResult)]
+            records.append(record)
+        self.write(records)
+        with self.lock:
+            self.count += 1
+            if failed:
+                self.failed += 1
+
+    def run(self,input):
+        # returns (number of messages, number of messages failed for any channel)
+        inflight = threading.BoundedSemaphore(self.maxinflight)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.maxinflight)
+        try:
+            lineno = 0
+            for line in input:
+                lineno += 1
+                if line.strip() == '':
+                    continue
+                try:
+                    content, severity = self.parseRecord(line)
+                except (ValueError, TypeError) as e:
+                    self.write([{'line': lineno, 'error': str(e)}])
+                    with self.lock:
+                        self.count += 1
+                        self.failed += 1
+                    continue
+                #block reading until a message in flight is done
+                inflight.acquire()
+                future = executor.submit(self.push, lineno, content, severity)
+                future.add_done_callback(lambda f: inflight.release())
+        finally:
+            executor.shutdown(wait=True)
+        return((self.count, self.failed))
+
+
+#
+# Config reload
+#
+class ConfigWatcher():
+    #
+    # check config.yml for changes every interval seconds, and call onreload(config) with the new config
+    # a new config which can not be loaded is reported and skipped, the old one stays in use
+    #   watcher = sendmessage.ConfigWatcher('config.yml', onreload)
+    #   watcher.start()
+    #
+    def __init__(self,configpath,onreload,interval=2):
+        self.configpath = ConfigLoader().getPath(configpath)
+        self.onreload = onreload
+        self.interval = interval
+        self.stat = self.getStat()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def getStat(self):
+        try:
+            stat = os.stat(self.configpath)
+            return((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+        except OSError:
+            return(None)
+
+    def check(self):
+        # returns True if the config is reloaded
+        stat = self.getStat()
+        if stat is None or stat == self.stat:
+            return(False)
+        #a config which is still being written is changed again when it is done
+        self.stat = stat
+        try:
+            config = ConfigLoader().loadConfig(self.configpath)
+            self.onreload(config)
+        except Exception as e:
+            print('config not reloaded: ' + str(e), file=sys.stderr)
+            return(False)
+        print('config reloaded: ' + self.configpath, file=sys.stderr)
+        return(True)
+
+    def start(self):
+        if self.thread is not None or not self.interval or self.interval <= 0:
+            return
+        self.thread = threading.Thread(target=self.watchLoop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def watchLoop(self):
+        while not self.stopping.wait(self.interval):
+            self.check()
+
+
+#
+# Daemon mode
+#
+def parseAddress(address):
+    # 'unix:/path/to/socket' for unix socket, 'host:port' or 'port' for http on localhost
+    if address.startswith('unix:'):
+        return(('unix', address[5:]))
+    host, _, port = address.rpartition(':')
+    if host == '':
+        host = '127.0.0.1'
+    return(('tcp', (host, int(port))))
+
+class DispatcherClosed(RuntimeError):
+    # the dispatcher is closed and not replaced, e.g. the daemon is stopping
+    pass
+
+@contextlib.contextmanager
+def useDispatcher(holder):
+    # yields the dispatcher of holder (the daemon or its server), which is not shut down by a reload until the block is done
+    dispatcher = holder.dispatcher
+    while not dispatcher.acquire():
+        if holder.dispatcher is dispatcher:
+            raise DispatcherClosed('dispatcher is closed')
+        #closed by a reload, holder has the new one already
+        dispatcher = holder.dispatcher
+    try:
+        yield dispatcher
+    finally:
+        dispatcher.release()
+
+class DaemonRequestHandler():
+    # combined with http.server.BaseHTTPRequestHandler by Daemon.serve, so that http.server is imported only in daemon mode
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # GET /health returns the circuit breaker of each endpoint, with status 503 if any of them is not closed
+        # GET /metrics returns the metrics in prometheus text format
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            try:
+                with useDispatcher(self.server) as dispatcher:
+                    body = dispatcher.getMetrics().encode('utf-8')
+            except DispatcherClosed as e:
+                self.reply(503, {'error': str(e)})
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if path != '/health':
+            self.reply(404, {'error': 'not found'})
+            return
+        try:
+            with useDispatcher(self.server) as dispatcher:
+                health = dispatcher.getHealth()
+        except DispatcherClosed as e:
+            self.reply(503, {'error': str(e)})
+            return
+        self.reply(200 if health['status'] == 'ok' else 503, health)
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+            content = data.get('content')
+            if not isinstance(content, list):
+                raise ValueError('content should be a list')
+            content = [str(v) for v in content]
+            severity = data.get('severity')
+            if severity is not None and not isinstance(severity, str):
+                raise ValueError('severity should be a string')
+        except Exception as e:
+            self.reply(400, {'error': repr(e)})
+            return
+        #the dispatcher may be replaced by a reload while the message is pushed, it is taken once for the message
+        try:
+            with useDispatcher(self.server) as dispatcher:
+                results = dispatcher.submit(content, severity)
+        except DispatcherClosed as e:
+            #the daemon is stopping, the message is not pushed
+            self.reply(503, {'error': str(e)})
+            return
+        self.reply(200, {'results': [[service, formatResult(resp)] for service,resp in results]})
+
+    def reply(self,code,data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        #client_address is empty for unix socket
+        if isinstance(self.client_address, tuple):
+            return(self.client_address[0])
+        return('unix')
+
+    def log_message(self,format,*args):
+        pass
+
+class Daemon():
+    #
+    # keep config and handlers loaded and accept messages over http on localhost or a unix socket
+    #   server: python3 sendmessage.py --serve=127.0.0.1:8765
+    #   client: python3 sendmessage.py --daemon=127.0.0.1:8765 'title' 'line 1' 'line 2'
+    # config.yml is reloaded when it is changed, optional settings in config.yml:
+    #   dispatcher:
+    #     reload: 2    #seconds between checks of config.yml, 0 to disable, changes of it apply after restart
+    #
+    def __init__(self,config,configpath=None):
+        self.dispatcher = Dispatcher(config)
+        self.dispatcher.startWorker()
+        self.server = None
+        self.watcher = None
+        if configpath is not None:
+            self.watcher = ConfigWatcher(configpath, self.reload, (config.get('dispatcher') or {}).get('reload', 2))
+
+    def reload(self,config):
+        # messages being pushed finish with the old dispatcher, new messages go to the new one
+        dispatcher = Dispatcher(config, self.dispatcher)
+        old = self.dispatcher
+        self.dispatcher = dispatcher
+        if self.server is not None:
+            self.server.dispatcher = dispatcher
+        old.close(dispatcher)
+        dispatcher.startWorker()
+
+    def metricsLoop(self):
+        # write the metrics file of the current config every interval
+        while True:
+            try:
+                with useDispatcher(self) as dispatcher:
+                    dispatcher.writeMetrics()
+                    interval = (dispatcher.config.get('metrics') or {}).get('interval', 15)
+            except DispatcherClosed:
+                return
+            time.sleep(interval)
+
+    def serve(self,address):
+        import http.server, socketserver
+        family, addr = parseAddress(address)
+        #headers and body of a reply are written separately, without nagle they are not held back by delayed acks of the client
+        handler = type('DaemonRequestHandler', (DaemonRequestHandler, http.server.BaseHTTPRequestHandler), {'disable_nagle_algorithm': family == 'tcp'})
+        if family == 'unix':
+            if os.path.exists(addr):
+                os.remove(addr)
+            servertype = type('ThreadingUnixHTTPServer', (socketserver.ThreadingMixIn, socketserver.UnixStreamServer), {'daemon_threads': True})
+            server = servertype(addr, handler)
+        else:
+            server = http.server.ThreadingHTTPServer(addr, handler)
+        server.dispatcher = self.dispatcher
+        self.server = server
+        if self.watcher is not None:
+            self.watcher.start()
+        threading.Thread(target=self.metricsLoop, daemon=True).start()
+        if threading.current_thread() is threading.main_thread():
+            #stopped by e.g. systemd, the digests held are pushed before exit
+            import signal
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print('serving on: ' + address)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.dispatcher.close()
+            if family == 'unix' and os.path.exists(addr):
+                os.remove(addr)
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self,path,timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+class DaemonClient():
+    #
+    # timeout is in seconds for each read of the reply, None to wait until the daemon has pushed the message
+    #
+    def __init__(self,address,timeout=None):
+        family, addr = parseAddress(address)
+        if family == 'unix':
+            self.connection = UnixHTTPConnection(addr, timeout=timeout)
         else:
-            # do something
-            return('Unknown exception!')
+            self.connection = http.client.HTTPConnection(addr[0], addr[1], timeout=timeout)
+
+    def connect(self):
+        # raises OSError if the daemon is not available, nothing has been sent to it then
+        self.connection.connect()
+
+    def push(self,content,severity=None):
+        # returns [(service, resp), ...] as Dispatcher.dispatch does
+        postdata = json.dumps({'content': content, 'severity': severity}).encode('utf-8')
+        self.connection.request('POST', '/', body=postdata, headers={'Content-Type': 'application/json'})
+        resp = self.connection.getresponse()
+        data = json.loads(resp.read().decode('utf-8'))
+        if resp.status != 200:
+            raise ValueError(data.get('error'))
+        return([tuple(r) for r in data['results']])
+
+    def close(self):
+        self.connection.close()
 
 
 if __name__ == '__main__':
 
+    #channels of other packages import sendmessage, which should be this module rather than a second copy of it
+    sys.modules.setdefault('sendmessage', sys.modules[__name__])
+
     # load config
-    opts,args = getopt.getopt(sys.argv[1:],'-c:',['config='])
+    opts,args = getopt.getopt(sys.argv[1:],'-c:',['config=','serve=','daemon=','timeout=','severity=','drain','stream='])
     configpath = "config.yml"
+    drain = False
+    serve = None
+    daemon = None
+    timeout = None
+    severity = None
+    stream = None
     for optname,optvalue in opts:
         if optname in ('-c','--config'):
             configpath = optvalue # config from -c or --config parameter
-            break
-    config = ConfigLoader().loadConfig(configpath)
-    for service in config:
-        if service == 'bark':
-            handler = Bark()
-            resp = handler.push(config[service], args)
-            print(service + ': ' + str(resp))
-        if service == 'serverchan':
-            handler = ServerChan()
-            resp = handler.push(config[service], args)
-            print(service + ': ' + str(resp))
-        if service == 'pushplus':
-            handler = PushPlus()
-            resp = handler.push(config[service], args)
-            print(service + ': ' + str(resp))
-        if service == 'iyuu':
-            handler = Iyuu()
-            resp = handler.push(config[service], args)
-            print(service + ': ' + str(resp))
-        if service == 'smtp':
-            handler = SMTP()
-            resp = handler.push(config[service], args)
-            print(service + ': ' + str(resp))
-        if service == 'dingtalk':
-            handler = DingTalk()
-            resp = handler.push(config[service], args)
-            print(service + ': ' + str(resp))
-        if service == 'feishu':
-            handler = FeiShu()
-            resp = handler.push(config[service], args)
-            print(service + ': ' + str(resp))
-        if service == 'wxbot':
-            handler = WxBot()
-            resp = handler.push(config[service], args)
-            print(service + ': ' + str(resp))
-        if service == 'wxapp':
-            handler = WxApp()
-            resp = handler.push(config[service], args)
-            print(service + ': ' + str(resp))
-        if service == 'telegram':
-            handler = Telegram()
-            resp = handler.push(config[service], args)
-            print(service + ': ' + str(resp))
+        if optname == '--serve':
+            serve = optvalue # run as daemon
+        if optname == '--daemon':
+            daemon = optvalue # send message via daemon
+        if optname == '--timeout':
+            timeout = float(optvalue) # seconds to wait for the reply of the daemon
+        if optname == '--severity':
+            severity = optvalue # severity for routing rules
+        if optname == '--drain':
+            drain = True # retry messages in outbox
+        if optname == '--stream':
+            stream = optvalue # push messages from a jsonl file, '-' for stdin
 
+    if daemon is not None:
+        client = DaemonClient(daemon, timeout)
+        try:
+            client.connect()
+        except OSError as e:
+            #daemon not available, push by this process instead
+            print('daemon not available: ' + str(e))
+        else:
+            try:
+                results = client.push(args, severity)
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                #the daemon may push the message anyway, so it is not pushed again by this process
+                print('daemon error: ' + str(e))
+                sys.exit(1)
+            finally:
+                client.close()
+            for service,resp in results:
+                print(service + ': ' + formatResult(resp))
+            sys.exit(0)
+
+    stdout = sys.stdout
+    if stream is not None:
+        #stdout is kept for the results
+        sys.stdout = sys.stderr
+    try:
+        config = ConfigLoader().loadConfig(configpath)
+    except ConfigError as e:
+        print('config error: ' + str(e), file=sys.stderr)
+        sys.exit(2)
+    finally:
+        sys.stdout = stdout
+    if stream is not None:
+        dispatcher = Dispatcher(config)
+        streamer = Streamer(dispatcher, sys.stdout)
+        if stream == '-':
+            count, failed = streamer.run(sys.stdin)
+        else:
+            with open(stream, 'r', encoding='utf-8') as file:
+                count, failed = streamer.run(file)
+        dispatcher.writeMetrics()
+        dispatcher.close()
+        print('stream: ' + str(count) + ' messages, ' + str(failed) + ' failed', file=sys.stderr)
+        sys.exit(1 if failed > 0 else 0)
+    elif serve is not None:
+        Daemon(config, configpath).serve(serve)
+    elif drain:
+        dispatcher = Dispatcher(config)
+        print('outbox: ' + str(dispatcher.drainOutbox()) + ' messages retried')
+        dispatcher.writeMetrics()
+        dispatcher.close()
+    else:
+        dispatcher = Dispatcher(config)
+        for service,resp in dispatcher.dispatch(args, severity):
+            print(service + ': ' + formatResult(resp))
+        dispatcher.writeMetrics()
+        dispatcher.close()